@@ -0,0 +1,266 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows; peak memory is reported as null there.
+
+import group_cells
+
+# Header written by testing/cell/test_cells.py, which group_cells.py reads.
+kFieldnames = ["Serial Number", "OCV (V)", "R0 (Ohm)", "R0 Charge (Ohm)", "R0 Discharge (Ohm)", "DCIR (Ohm)", "DCIR Charge (Ohm)", "DCIR Discharge (Ohm)"]
+
+# Synthetic inventory shape, roughly matching cell_data.csv.
+kDcirMedian_ohms = 0.069
+kDcirSigma = 0.03 # Log-space standard deviation of DCIR
+kOutlierFraction = 0.02 # Share of cells drawn from the outlier tails
+kOcvMean_volts = 3.56
+kOcvSigma_volts = 0.001
+
+kStrategies = ["greedy", "kk", "greedy+refine", "kk+refine", "window+kk+refine", "window+skips+kk+refine", "weighted",
+               "restarts", "regroup"]
+kRefined = ("greedy+refine", "kk+refine", "window+kk+refine", "window+skips+kk+refine", "weighted") # Run to the time budget
+
+# Fixed workloads for the seeded strategies, so their spread is comparable between reports.
+kSkipsPerModule = 1 # window+skips: spare cells per module for the refinement to choose from
+kRestarts = 4 # restarts: seeds args.seed .. args.seed + kRestarts - 1, no wall clock
+kRestartWorkers = 2
+kRestartMaxSize = 30000 # Every restart refines to convergence, which takes minutes beyond this
+kRegroupRejects = 20 # regroup: grouped cells rejected after grouping, at most one per unused cell...
+kRegroupOpenFraction = 0.1 # ...with this share of modules still unfinished and able to give up a cell
+
+# A run counts as a regression when it is this much slower, or its spread this much wider,
+# than the baseline report.
+kRuntimeTolerance = 0.25
+kRuntimeFloor_seconds = 0.05 # Differences below this are timer noise
+kSpreadTolerance = 0.05
+
+def generate_inventory(file_path, count, seed):
+    """Writes a synthetic cell_data.csv with lognormal DCIR and high/low outlier tails."""
+    rng = random.Random(seed)
+    rows_per_box = 10 * 13 # Boxes of 10 rows x 13 columns, as in generate_serials.py
+    with open(file_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(kFieldnames)
+        for i in range(count):
+            box, position = divmod(i, rows_per_box)
+            row, column = divmod(position, 13)
+            serial = f"{box + 1}{string.ascii_uppercase[row]}{column + 1:02}"
+
+            dcir = rng.lognormvariate(math.log(kDcirMedian_ohms), kDcirSigma)
+            if rng.random() < kOutlierFraction:
+                # Bad cells are mostly high resistance; a few measure suspiciously low.
+                dcir *= rng.uniform(1.2, 2.0) if rng.random() < 0.8 else rng.uniform(0.6, 0.85)
+            dcir_charge = dcir * rng.uniform(0.70, 0.76)
+            dcir_discharge = 2 * dcir - dcir_charge
+            r0 = dcir * rng.uniform(0.36, 0.40)
+            r0_charge = r0 * rng.uniform(0.80, 0.86)
+            r0_discharge = 2 * r0 - r0_charge
+            ocv = rng.gauss(kOcvMean_volts, kOcvSigma_volts)
+            writer.writerow([serial, f"{ocv:.6f}", f"{r0:.8f}", f"{r0_charge:.7f}", f"{r0_discharge:.7f}",
+                             f"{dcir:.8f}", f"{dcir_charge:.7f}", f"{dcir_discharge:.7f}"])
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    # Restart workers are children of the benchmark process; count the largest of them too.
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_regroup(table, modules, seed):
+    """Rejects a seeded sample of grouped cells and replaces them the way group_cells.regroup() does.
+
+    Each replacement uses up an unused cell, so no more cells are rejected than the pool holds.
+    Only the incremental work is timed: indexing the unused pool and the replacements.
+    """
+    rng = random.Random(seed)
+    grouped = [c for m in modules for c in m.cells]
+    rejected = rng.sample(grouped, min(len(grouped), len(table) - len(grouped), kRegroupRejects))
+    open_modules = rng.sample(modules, max(1, int(len(modules) * kRegroupOpenFraction)))
+    start = time.perf_counter()
+    assigned = set(grouped)
+    unused = sorted((i for i in range(len(table)) if i not in assigned), key=table.conductance.__getitem__)
+    unused_keys = [table.conductance[i] for i in unused]
+    module_of = {c: m for m in modules for c in m.cells}
+    for cell in rejected:
+        module = module_of[cell]
+        if cell not in module.cells: # An earlier replacement moved it out of an open module
+            module = next(m for m in modules if cell in m.cells)
+        group_cells.replace_cell(table, modules, module, cell, unused, unused_keys, open_modules)
+    return time.perf_counter() - start
+
+def run_strategy(file_path, strategy, series, parallel, packs, time_budget, seed):
+    """Runs one strategy the way group_cells.main() would and returns its measurements.
+
+    Meant to run in a fresh process so that the peak RSS belongs to this strategy alone.
+    """
+    start = time.perf_counter()
+    table = group_cells.read_cells(file_path)
+    read_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    series = series * packs
+    total_needed = series * parallel
+    cells = sorted(range(len(table)), key=table.dcir.__getitem__)
+    spares = []
+    if strategy.startswith("window+skips"):
+        skips = min(len(cells) - total_needed, kSkipsPerModule * series)
+        start_index, span, _, _ = group_cells.select_window(table, cells, total_needed, parallel, skips)
+        offset = start_index + skips // 2
+        spares = cells[start_index:offset] + cells[offset + total_needed:start_index + span]
+        selected = cells[offset:offset + total_needed]
+    else:
+        if strategy.startswith("window"):
+            start_index, _, _, _ = group_cells.select_window(table, cells, total_needed, parallel)
+        else:
+            start_index = (len(cells) - total_needed) // 2
+        selected = cells[start_index:start_index + total_needed]
+    selected.sort(key=table.conductance.__getitem__, reverse=True)
+
+    if strategy == "restarts":
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, _, modules = group_cells.run_restarts(table, selected, len(selected), series, parallel, "kk",
+                                                     kRestarts, seed, kRestartWorkers, None)
+    elif "kk" in strategy or strategy == "regroup":
+        modules = group_cells.group_largest_differencing(table, selected, series, parallel)
+    else:
+        modules = group_cells.group_greedy(table, selected, series, parallel)
+    if strategy.endswith("refine"):
+        group_cells.refine_swaps(table, modules, time_budget, spares, verbose=False)
+    elif strategy == "weighted":
+        weights = {"dcir": 1.0, "r0": 0.5, "ocv": 0.2}
+        group_cells.refine_weighted(table, modules, weights, time_budget, verbose=False)
+    group_seconds = time.perf_counter() - start
+    if strategy == "regroup":
+        # What matters is how fast an existing assignment is patched, not how it was built.
+        group_seconds = run_regroup(table, modules, seed)
+
+    spread, percent = group_cells.resistance_spread(modules)
+    return {
+        "read_seconds": read_seconds,
+        "group_seconds": group_seconds,
+        "peak_rss_mb": _peak_rss_mb(),
+        "spread_ohm": spread,
+        "spread_percent": percent,
+    }
+
+def compare(results, baseline):
+    """Returns a list of regression messages versus a previous report."""
+    previous = {(r["size"], r["strategy"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        old = previous.get((r["size"], r["strategy"]))
+        if old is None:
+            continue
+        # Refinement runs to its time budget, so only the spread is comparable for those.
+        if r["strategy"] not in kRefined:
+            if r["group_seconds"] > old["group_seconds"] * (1 + kRuntimeTolerance) + kRuntimeFloor_seconds:
+                regressions.append(f"{r['strategy']} @ {r['size']}: {old['group_seconds']:.3f} s -> {r['group_seconds']:.3f} s")
+        if r["spread_percent"] > old["spread_percent"] * (1 + kSpreadTolerance) + 1e-9:
+            regressions.append(f"{r['strategy']} @ {r['size']}: spread {old['spread_percent']:.4f}% -> {r['spread_percent']:.4f}%")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cell grouping strategies on synthetic inventories.")
+    parser.add_argument("--sizes", default="300,3000,30000,300000",
+                        help="Comma-separated inventory sizes to generate (default: 300,3000,30000,300000)")
+    parser.add_argument("--series", type=int, default=32, help="Cells in series per pack")
+    parser.add_argument("--parallel", type=int, default=9, help="Cells in parallel per module")
+    parser.add_argument("--strategies", default=",".join(kStrategies),
+                        help=f"Comma-separated strategies to run (default: all of {', '.join(kStrategies)})")
+    parser.add_argument("--time-budget", type=float, default=2.0, help="Refinement seconds for the +refine and weighted strategies")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic inventories, restarts and regroup rejections")
+    parser.add_argument("--inventory-dir", default=None, help="Keep the generated inventories here instead of a temporary directory")
+    parser.add_argument("--output", default="grouping_benchmark.json", help="Path to the JSON report")
+    parser.add_argument("--baseline", default=None, help="Previous JSON report to check for speed or balance regressions")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    strategies = [s.strip() for s in args.strategies.split(",")]
+    unknown = [s for s in strategies if s not in kStrategies]
+    if unknown:
+        print(f"Error: unknown strategies: {', '.join(unknown)}")
+        sys.exit(1)
+    if "weighted" in strategies and group_cells.np is None:
+        print("Warning: numpy is not installed, skipping the weighted strategy")
+        strategies.remove("weighted")
+
+    # Each run gets a fresh process so peak memory and timings don't leak between runs.
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        inventory_dir = args.inventory_dir or temp_dir
+        os.makedirs(inventory_dir, exist_ok=True)
+        for size in sizes:
+            # Build as many packs as fit into ~90% of the inventory so grouping work scales with it.
+            packs = max(1, int(size * 0.9) // (args.series * args.parallel))
+            if packs * args.series * args.parallel > size:
+                print(f"Warning: skipping size {size}, too small for one {args.series}s{args.parallel}p pack")
+                continue
+            file_path = os.path.join(inventory_dir, f"inventory_{size}.csv")
+            if not os.path.exists(file_path):
+                generate_inventory(file_path, size, args.seed)
+
+            for strategy in strategies:
+                if strategy == "restarts" and size > kRestartMaxSize:
+                    print(f"{size:>8} cells {strategy:<22} skipped above {kRestartMaxSize} cells")
+                    continue
+                if strategy == "regroup" and packs * args.series * args.parallel == size:
+                    print(f"{size:>8} cells {strategy:<22} skipped, no unused cells to replace with")
+                    continue
+                # Unlike multiprocessing.Pool workers, these may start the restart strategy's own workers.
+                try:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        result = executor.submit(run_strategy, file_path, strategy, args.series, args.parallel, packs,
+                                                 args.time_budget, args.seed).result()
+                except (Exception, SystemExit) as e:
+                    # group_cells reports some errors with sys.exit(), which arrives here as SystemExit.
+                    # Keep going so the results already collected still make it into the report.
+                    print(f"{size:>8} cells {strategy:<22} failed: {e!r}")
+                    continue
+                result.update(size=size, strategy=strategy, packs=packs)
+                results.append(result)
+                peak = f"{result['peak_rss_mb']:.0f} MB" if result["peak_rss_mb"] is not None else "n/a"
+                print(f"{size:>8} cells {strategy:<22} group {result['group_seconds']:8.3f} s  "
+                      f"read {result['read_seconds']:7.2f} s  peak {peak:>8}  spread {result['spread_percent']:.5f}%")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "series": args.series,
+        "parallel": args.parallel,
+        "time_budget": args.time_budget,
+        "seed": args.seed,
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f))
+        for message in regressions:
+            print(f"Regression: {message}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+if __name__ == "__main__":
+    main()
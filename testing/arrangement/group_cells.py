@@ -1,21 +1,104 @@
 import csv
 import argparse
+import bisect
+import heapq
+import itertools
+import math
+import os
+import random
+import statistics
 import sys
+import time
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from dataclasses import dataclass, field
-from typing import List
+from typing import Dict, List, Optional
 
-@dataclass
-class Cell:
-    serial_number: str
-    dcir: float
-    conductance: float
-    original_index: int
+# NumPy is only needed for the weighted multi-parameter objective (--weights).
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-@dataclass
+# Relative noise applied to each cell's conductance when ordering cells for a randomized restart.
+kRestartJitter = 0.002
+# Default cap on a restart's refinement swaps, per module. Refinement usually converges within
+# a few swaps per module; the cap bounds the rest without depending on timing.
+kRestartSwapsPerModule = 4
+
+# Input CSV columns usable in --weights. Resistances combine in parallel as conductances;
+# OCV is averaged across the parallel cells.
+kParameterColumns = {
+    "ocv": 1,
+    "r0": 2,
+    "r0_charge": 3,
+    "r0_discharge": 4,
+    "dcir": 5,
+    "dcir_charge": 6,
+    "dcir_discharge": 7,
+}
+
+# Equivalent-circuit parameters added by testing/cell/fit_traces.py, found by header wherever
+# they are in the file. Time constants are averaged across the parallel cells like OCV.
+kFitPairs = 2
+kFitColumns = {"fit_r0": "Fit R0 (Ohm)"}
+for k in range(1, kFitPairs + 1):
+    kFitColumns[f"fit_r{k}"] = f"Fit R{k} (Ohm)"
+    kFitColumns[f"fit_tau{k}"] = f"Fit Tau{k} (s)"
+kAveragedParameters = {"ocv"} | {f"fit_tau{k}" for k in range(1, kFitPairs + 1)}
+
+kParameters = tuple(kParameterColumns) + tuple(kFitColumns)
+
+class CellTable:
+    """Column store for the cell inventory.
+
+    Each measured parameter is an array('d') column and everything else refers to a cell by
+    its row index, so a cell costs a few machine words instead of a Python object with a
+    float object per field. Missing optional parameters are stored as NaN.
+    """
+    __slots__ = ("serial_numbers", "original_index", "conductance") + kParameters
+
+    def __init__(self):
+        self.serial_numbers: List[str] = []
+        self.original_index = array('q')
+        self.conductance = array('d')
+        for name in kParameters:
+            setattr(self, name, array('d'))
+
+    def __len__(self) -> int:
+        return len(self.serial_numbers)
+
+    def column(self, name: str) -> array:
+        return getattr(self, name)
+
+    def append(self, serial_number: str, original_index: int, values: Dict[str, float]):
+        self.serial_numbers.append(serial_number)
+        self.original_index.append(original_index)
+        self.conductance.append(1.0 / values["dcir"])
+        for name in kParameters:
+            getattr(self, name).append(values[name])
+
+    def values(self, row: int) -> Dict[str, float]:
+        return {name: getattr(self, name)[row] for name in kParameters}
+
+    def update(self, row: int, values: Dict[str, float]):
+        self.conductance[row] = 1.0 / values["dcir"]
+        for name in kParameters:
+            getattr(self, name)[row] = values[name]
+
+    def compact(self, keep: List[bool]):
+        """Drops the rows whose keep flag is False, in place."""
+        self.serial_numbers = [s for s, k in zip(self.serial_numbers, keep) if k]
+        for name in ("original_index", "conductance") + kParameters:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, itertools.compress(column, keep)))
+
+@dataclass(slots=True)
 class Module:
     id: int
-    cells: List[Cell] = field(default_factory=list)
+    cells: List[int] = field(default_factory=list) # Row indices into the CellTable
     total_conductance: float = 0.0
+    pack: int = 1
 
     @property
     def resistance(self) -> float:
@@ -23,50 +106,800 @@ class Module:
             return 0.0
         return 1.0 / self.total_conductance
 
-def read_cells(file_path: str) -> List[Cell]:
-    cells = []
+def _optional_float(row: List[str], column: int) -> float:
     try:
-        with open(file_path, mode='r', newline='', encoding='utf-8-sig') as f:
-            reader = csv.reader(f)
-            header = next(reader, None) # Skip header
-            for i, row in enumerate(reader):
-                if not row or len(row) < 6:
-                    continue
-                
-                serial = row[0]
-                try:
-                    dcir = float(row[5])
-                    if dcir <= 0:
-                        print(f"Warning: skipping row {i+2}, non-positive DCIR: {dcir}")
+        return float(row[column])
+    except (IndexError, ValueError):
+        return math.nan
+
+def _resolve_retests(table: CellTable, retests: Dict[int, List[Dict[str, float]]], policy: str, tolerance: float) -> int:
+    """Applies the median or reject policy to cells measured more than once. Returns the number rejected."""
+    keep = [True] * len(table)
+    for row, measurements in retests.items():
+        if policy == "median":
+            merged = {}
+            for name in kParameters:
+                present = [m[name] for m in measurements if not math.isnan(m[name])]
+                merged[name] = statistics.median(present) if present else math.nan
+            table.update(row, merged)
+        else:
+            dcirs = [m["dcir"] for m in measurements]
+            if (max(dcirs) - min(dcirs)) / statistics.median(dcirs) * 100 > tolerance:
+                print(f"Warning: rejecting {table.serial_numbers[row]}, {len(dcirs)} DCIR measurements disagree: "
+                      + ", ".join(f"{d:.6f}" for d in dcirs))
+                keep[row] = False
+            else:
+                table.update(row, measurements[-1])
+    rejected = keep.count(False)
+    if rejected:
+        table.compact(keep)
+    return rejected
+
+def _add_measurement(cells: CellTable, row_of: Dict[str, int], retests: Dict[int, List[Dict[str, float]]],
+                     serial: str, values: Dict[str, float], original_index: int, policy: str) -> bool:
+    """Adds a cell, or folds a retest into its existing row. Returns True for a retest."""
+    existing = row_of.setdefault(serial, len(cells))
+    if existing == len(cells):
+        cells.append(serial, original_index, values)
+        return False
+    if policy == "latest":
+        cells.update(existing, values)
+    else:
+        retests.setdefault(existing, [cells.values(existing)]).append(values)
+    return True
+
+def _finish_retests(cells: CellTable, row_of: Dict[str, int], retests: Dict[int, List[Dict[str, float]]],
+                    duplicate_rows: int, policy: str, tolerance: float):
+    if duplicate_rows:
+        rejected = _resolve_retests(cells, retests, policy, tolerance) if retests else 0
+        print(f"Merged {duplicate_rows} retest rows into {len(row_of)} cells using the {policy} policy"
+              + (f", rejected {rejected} cells" if rejected else ""))
+
+def read_cells(file_paths, policy: str = "latest", tolerance: float = 2.0) -> CellTable:
+    """Streams one or more test logs into a CellTable, one row per serial number.
+
+    Logs are read row by row in the order given, so memory follows the number of distinct
+    cells rather than the size of the logs. A cell that was retested keeps its first position
+    in the inventory and its measurements are resolved by policy: the latest row wins, the
+    per-parameter median is used, or the cell is rejected when its DCIR readings differ by more
+    than tolerance percent of their median (otherwise the latest row is used).
+    """
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    cells = CellTable()
+    row_of: Dict[str, int] = {}
+    # Only retested cells keep their measurement history, for the median and reject policies.
+    retests: Dict[int, List[Dict[str, float]]] = {}
+    rows_before = 0
+    duplicate_rows = 0
+    for file_path in file_paths:
+        try:
+            with open(file_path, mode='r', newline='', encoding='utf-8-sig') as f:
+                reader = csv.reader(f)
+                header = next(reader, None) or []
+                columns = dict(kParameterColumns)
+                columns.update((name, header.index(title)) for name, title in kFitColumns.items() if title in header)
+                absent = {name: math.nan for name in kFitColumns if name not in columns}
+                i = -1
+                for i, row in enumerate(reader):
+                    if not row or len(row) < 6:
                         continue
-                    
-                    cells.append(Cell(serial, dcir, 1.0 / dcir, i))
-                except ValueError:
-                    print(f"Warning: skipping row {i+2}, invalid DCIR: {row[5]}")
+
+                    serial = row[0].strip()
+                    try:
+                        dcir = float(row[5])
+                        if dcir <= 0:
+                            print(f"Warning: skipping {file_path} row {i+2}, non-positive DCIR: {dcir}")
+                            continue
+
+                        values = {name: _optional_float(row, column) for name, column in columns.items()}
+                        values.update(absent)
+                        values["dcir"] = dcir
+                    except ValueError:
+                        print(f"Warning: skipping {file_path} row {i+2}, invalid DCIR: {row[5]}")
+                        continue
+
+                    duplicate_rows += _add_measurement(cells, row_of, retests, serial, values, rows_before + i, policy)
+                rows_before += i + 1
+        except FileNotFoundError:
+            print(f"Error: File not found: {file_path}")
+            sys.exit(1)
+        except Exception as e:
+            print(f"Error reading file: {e}")
+            sys.exit(1)
+
+    _finish_retests(cells, row_of, retests, duplicate_rows, policy, tolerance)
+    return cells
+
+def read_database(file_path: str, since: Optional[str] = None, until: Optional[str] = None, station: Optional[str] = None,
+                  policy: str = "latest", tolerance: float = 2.0) -> CellTable:
+    """Loads cells from the SQLite store written by testing/cell, optionally filtered by test time and station.
+
+    Retests are resolved the same way as read_cells().
+    """
+    if not os.path.exists(file_path):
+        print(f"Error: File not found: {file_path}")
+        sys.exit(1)
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cell"))
+    import cell_database
+
+    cells = CellTable()
+    row_of: Dict[str, int] = {}
+    retests: Dict[int, List[Dict[str, float]]] = {}
+    duplicate_rows = 0
+    db = cell_database.CellDatabase(file_path)
+    try:
+        for i, (serial, values) in enumerate(db.measurements(since, until, station)):
+            if not values["dcir"] > 0:
+                print(f"Warning: skipping a test of {serial}, missing or non-positive DCIR: {values['dcir']}")
+                continue
+            values.update((name, math.nan) for name in kFitColumns) # The database has no fitted parameters
+            duplicate_rows += _add_measurement(cells, row_of, retests, serial, values, i, policy)
+    finally:
+        db.close()
+
+    _finish_retests(cells, row_of, retests, duplicate_rows, policy, tolerance)
+    return cells
+
+def window_score(table: CellTable, cells: List[int], prefix: List[float], start: int, span: int, parallel: int) -> float:
+    """Range-based score for cells[start:start + span], in O(1): lower is a tighter window.
+
+    The score is the conductance range of a single cell in the window over the mean module
+    conductance. It ranks windows by how alike their cells are. It is not a prediction of the
+    module spread, which the grouping usually brings far below it. The cells must be sorted by
+    ascending DCIR; prefix holds running sums of their conductance.
+    """
+    module_conductance = (prefix[start + span] - prefix[start]) / span * parallel
+    return (table.conductance[cells[start]] - table.conductance[cells[start + span - 1]]) / module_conductance
+
+def select_window(table: CellTable, cells: List[int], total_needed: int, parallel: int, skips: int = 0):
+    """Finds the contiguous run of the DCIR-sorted cells with the lowest window_score().
+
+    The run is total_needed + skips cells long; up to `skips` of them may be left out later by
+    the refinement. Returns (start index, span, score, score of the middle run), the last
+    being what the default middle selection would get, for comparison.
+    """
+    span = total_needed + skips
+    prefix = list(itertools.accumulate((table.conductance[i] for i in cells), initial=0.0))
+    best_start = 0
+    best_score = float("inf")
+    for start in range(len(cells) - span + 1):
+        score = window_score(table, cells, prefix, start, span, parallel)
+        if score < best_score:
+            best_start, best_score = start, score
+    middle_score = window_score(table, cells, prefix, (len(cells) - span) // 2, span, parallel)
+    return best_start, span, best_score, middle_score
+
+def group_greedy(table: CellTable, cells: List[int], series: int, parallel: int) -> List[Module]:
+    """Assigns each cell, in order, to the non-full module with the lowest total conductance.
+
+    Modules live in a min-heap keyed on (total_conductance, index) so each placement costs
+    O(log S) instead of a scan over every module. A module that fills up is simply not pushed
+    back. Ties go to the lowest module id, the same as min() over the module list.
+    """
+    conductance = table.conductance
+    modules = [Module(id=i+1) for i in range(series)]
+    heap = [(0.0, i) for i in range(series)]
+
+    for cell in cells:
+        if not heap:
+            print(f"Error: Algorithm error, no eligible modules for cell {table.serial_numbers[cell]}")
+            sys.exit(1)
+
+        total_conductance, index = heapq.heappop(heap)
+        best_module = modules[index]
+
+        best_module.cells.append(cell)
+        best_module.total_conductance = total_conductance + conductance[cell]
+
+        if len(best_module.cells) < parallel:
+            heapq.heappush(heap, (best_module.total_conductance, index))
+
+    return modules
+
+def group_largest_differencing(table: CellTable, cells: List[int], series: int, parallel: int) -> List[Module]:
+    """Balanced multi-way Karmarkar-Karp (largest differencing) partition.
+
+    The cells, sorted by descending conductance, are cut into `parallel` slices of `series`
+    cells. Each slice is a partial solution of `series` single-cell subsets. The two partials
+    with the largest max-min difference are repeatedly merged by pairing the largest subset of
+    one with the smallest of the other, so every final subset holds exactly `parallel` cells.
+    """
+    # A partial is a list of [total_conductance, cells] subsets sorted by descending total.
+    conductance = table.conductance
+    heap = []
+    for k in range(parallel):
+        chunk = cells[k * series:(k + 1) * series]
+        partial = sorted(([conductance[c], [c]] for c in chunk), key=lambda s: s[0], reverse=True)
+        heapq.heappush(heap, (-(partial[0][0] - partial[-1][0]), k, partial))
+
+    while len(heap) > 1:
+        _, k, a = heapq.heappop(heap)
+        _, _, b = heapq.heappop(heap)
+        merged = []
+        for big, small in zip(a, reversed(b)):
+            # Extend the longer cell list with the shorter one to keep merges cheap.
+            if len(big[1]) < len(small[1]):
+                big, small = small, big
+            big[1].extend(small[1])
+            merged.append([big[0] + small[0], big[1]])
+        merged.sort(key=lambda s: s[0], reverse=True)
+        heapq.heappush(heap, (-(merged[0][0] - merged[-1][0]), k, merged))
+
+    _, _, partial = heap[0]
+    modules = []
+    for i, (total_conductance, subset) in enumerate(partial):
+        modules.append(Module(id=i+1, cells=subset, total_conductance=total_conductance))
+    return modules
+
+def resistance_spread(modules: List[Module]):
+    """Returns (max - min module resistance, spread as a percentage of the average)."""
+    resistances = [m.resistance for m in modules]
+    avg_res = sum(resistances) / len(resistances)
+    diff = max(resistances) - min(resistances)
+    percent_diff = (diff / avg_res) * 100 if avg_res > 0 else 0
+    return diff, percent_diff
+
+def _try_swap(table: CellTable, module: Module, partner: Module) -> bool:
+    """Swaps the cell pair that best evens out two modules. Returns False if none helps."""
+    high, low = (module, partner) if module.total_conductance > partner.total_conductance else (partner, module)
+    gap = high.total_conductance - low.total_conductance
+    if gap <= 0:
+        return False
+
+    # Moving conductance d from high to low shrinks the pair's gap for any 0 < d < gap and
+    # is best at d = gap / 2. Look up the closest low-side cell for each high-side cell.
+    conductance = table.conductance
+    low_cells = sorted(low.cells, key=conductance.__getitem__)
+    low_keys = [conductance[c] for c in low_cells]
+    best = None
+    best_error = gap / 2
+    for hi_cell in high.cells:
+        target = conductance[hi_cell] - gap / 2
+        j = bisect.bisect_left(low_keys, target)
+        for k in (j - 1, j):
+            if 0 <= k < len(low_keys):
+                d = conductance[hi_cell] - low_keys[k]
+                if 0 < d < gap and abs(d - gap / 2) < best_error:
+                    best = (hi_cell, low_cells[k], d)
+                    best_error = abs(d - gap / 2)
+    if best is None:
+        return False
+
+    hi_cell, lo_cell, d = best
+    high.cells[high.cells.index(hi_cell)] = lo_cell
+    low.cells[low.cells.index(lo_cell)] = hi_cell
+    high.total_conductance -= d
+    low.total_conductance += d
+    return True
+
+def _try_spare_swap(table: CellTable, module: Module, spares: List[int], target: float, floor: float, ceiling: float) -> bool:
+    """Trades one module cell for a spare so the module total moves toward target.
+
+    The new total must stay strictly inside (floor, ceiling) so the pack spread never grows.
+    spares is kept sorted by conductance. Returns False if no trade helps.
+    """
+    conductance = table.conductance
+    spare_keys = [conductance[c] for c in spares]
+    best = None
+    best_error = abs(module.total_conductance - target)
+    for cell in module.cells:
+        # The ideal spare brings the module total exactly to target.
+        ideal = conductance[cell] + target - module.total_conductance
+        j = bisect.bisect_left(spare_keys, ideal)
+        for k in (j - 1, j):
+            if 0 <= k < len(spare_keys):
+                new_total = module.total_conductance - conductance[cell] + spare_keys[k]
+                if floor < new_total < ceiling and abs(new_total - target) < best_error:
+                    best = (cell, k, new_total)
+                    best_error = abs(new_total - target)
+    if best is None:
+        return False
+
+    cell, k, new_total = best
+    module.cells[module.cells.index(cell)] = spares.pop(k)
+    bisect.insort(spares, cell, key=conductance.__getitem__)
+    module.total_conductance = new_total
+    return True
+
+def refine_swaps(table: CellTable, modules: List[Module], time_budget: float, spares: Optional[List[int]] = None,
+                 stop_spread: float = 0.0, verbose: bool = True, max_swaps: Optional[int] = None):
+    """Pairwise-swap local search between the extreme modules, bounded by time_budget seconds.
+
+    Each round tries to swap one cell between the highest-conductance module and the lowest
+    one, falling back to the next partners in line. Every accepted swap strictly lowers the sum
+    of squared module conductances, so the search stops on its own once no swap helps.
+    If spares are given, the extreme modules may also trade a cell for a spare; the list is
+    updated in place to hold whichever cells end up unused. The search also stops once the
+    resistance spread is at or below stop_spread Ohm, or after max_swaps swaps if given.
+    Prints the spread reached after each second of compute (unless verbose is False) and
+    returns it as a list of (seconds, spread) points.
+    """
+    if spares:
+        spares.sort(key=table.conductance.__getitem__)
+    start = time.monotonic()
+    next_report = 1.0
+    history = [(0.0, resistance_spread(modules)[0])]
+    swaps = 0
+
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= time_budget or swaps == max_swaps:
+            break
+        if elapsed >= next_report:
+            diff, percent_diff = resistance_spread(modules)
+            history.append((elapsed, diff))
+            if verbose:
+                print(f"  {int(next_report)} s: spread {diff:.6f} Ohm ({percent_diff:.4f}%) after {swaps} swaps")
+            next_report = float(int(elapsed) + 1)
+
+        ordered = sorted(modules, key=lambda m: m.total_conductance)
+        highest, lowest = ordered[-1], ordered[0]
+        if lowest.resistance - highest.resistance <= stop_spread:
+            break
+        if not (any(_try_swap(table, highest, m) for m in ordered[:-1]) or
+                any(_try_swap(table, lowest, m) for m in reversed(ordered[1:]))):
+            if not spares:
+                break
+            floor, ceiling = lowest.total_conductance, highest.total_conductance
+            target = sum(m.total_conductance for m in modules) / len(modules)
+            if not (_try_spare_swap(table, highest, spares, target, floor, ceiling) or
+                    _try_spare_swap(table, lowest, spares, target, floor, ceiling)):
+                break
+        swaps += 1
+
+    elapsed = time.monotonic() - start
+    diff, percent_diff = resistance_spread(modules)
+    history.append((elapsed, diff))
+    if verbose:
+        print(f"Refinement: {swaps} swaps in {elapsed:.2f} s, spread {diff:.6f} Ohm ({percent_diff:.4f}%)")
+    return history
+
+def parse_weights(text: str) -> Dict[str, float]:
+    """Parses "dcir=1,r0=0.5,ocv=0.2" into a {parameter: weight} dict."""
+    weights = {}
+    for item in text.split(","):
+        name, _, value = item.partition("=")
+        name = name.strip().lower()
+        if name not in kParameters:
+            raise ValueError(f"unknown parameter '{name}', expected one of {', '.join(kParameters)}")
+        weights[name] = float(value) if value else 1.0
+    return weights
+
+def cell_features(table: CellTable, cells: List[int], names: List[str], parallel: int):
+    """N x K array of what each cell adds to its module's value of each named parameter."""
+    rows = np.asarray(cells, dtype=np.intp)
+    # The array('d') columns are read through the buffer protocol without copying.
+    values = np.column_stack([np.frombuffer(table.column(name), dtype=np.float64)[rows] for name in names])
+    averaged = np.array([name in kAveragedParameters for name in names])
+    return np.where(averaged, values / parallel, 1.0 / values)
+
+def weighted_cost(sums, means, weights):
+    """Sum over parameters of weight * (max - min module value) / mean module value.
+
+    sums is an S x K array of module values; extra leading axes are treated as a batch of
+    candidate groupings, so the cost of many swaps can be scored in one call.
+    """
+    spread = sums.max(axis=-2) - sums.min(axis=-2)
+    return (weights * spread / means).sum(axis=-1)
+
+def refine_weighted(table: CellTable, modules: List[Module], weights: Dict[str, float], time_budget: float,
+                    verbose: bool = True, max_swaps: Optional[int] = None) -> float:
+    """Pairwise-swap local search on the weighted multi-parameter objective.
+
+    Each round takes the module furthest from the mean (weighted over all parameters) and pairs
+    it with the other modules, most opposite first. All parallel x parallel swaps with a partner
+    are scored at once with NumPy, and the best one is applied if it lowers the pack cost. If no
+    partner helps, the highest and lowest module of each weighted parameter get their turn, as
+    only a swap involving one of them can lower the cost; the search ends once none of them can,
+    after time_budget seconds, or after max_swaps swaps if given. Module cell lists are updated in place. Returns the final cost.
+    """
+    names = list(weights)
+    w = np.array([weights[name] for name in names])
+    parallel = len(modules[0].cells)
+    cells = [c for m in modules for c in m.cells]
+    features = cell_features(table, cells, names, parallel)
+    members = np.arange(len(cells)).reshape(len(modules), parallel)
+    sums = features[members].sum(axis=1)
+    # Swaps never change the pack totals, so the per-parameter means stay fixed.
+    means = sums.mean(axis=0)
+    current = float(weighted_cost(sums, means, w))
+    initial = current
+    columns = np.arange(len(names))
+
+    start = time.monotonic()
+    swaps = 0
+    while time.monotonic() - start < time_budget and swaps != max_swaps:
+        deviation = w * (sums - means) / means
+        # The three highest and lowest modules per parameter are enough to find the extremes
+        # of the modules not involved in a swap.
+        order = np.argsort(sums, axis=0)
+        top, bottom = order[-3:], order[:3]
+        # Candidates: the furthest module overall, then each parameter's extremes, most weighted first.
+        by_weight = np.argsort(-w)
+        extremes = [int(m) for k in by_weight for m in (top[-1, k], bottom[0, k])]
+        candidates = list(dict.fromkeys([int(np.abs(deviation).sum(axis=1).argmax())] + extremes))
+
+        improved = False
+        for a in candidates:
+            for b in np.argsort(deviation @ deviation[a]):
+                if b == a:
                     continue
+                outside_hi = np.where((top != a) & (top != b), sums[top, columns], -np.inf).max(axis=0)
+                outside_lo = np.where((bottom != a) & (bottom != b), sums[bottom, columns], np.inf).min(axis=0)
+
+                # delta[i, j] is what module a gains by trading its cell i for b's cell j.
+                delta = features[members[b]][None, :, :] - features[members[a]][:, None, :]
+                new_a = sums[a] + delta
+                new_b = sums[b] - delta
+                hi = np.maximum(np.maximum(new_a, new_b), outside_hi)
+                lo = np.minimum(np.minimum(new_a, new_b), outside_lo)
+                costs = (w * (hi - lo) / means).sum(axis=-1)
+
+                i, j = np.unravel_index(costs.argmin(), costs.shape)
+                if costs[i, j] < current:
+                    members[a, i], members[b, j] = members[b, j], members[a, i]
+                    sums[a] = new_a[i, j]
+                    sums[b] = new_b[i, j]
+                    current = float(costs[i, j])
+                    swaps += 1
+                    improved = True
+                    break
+            if improved or time.monotonic() - start >= time_budget:
+                break
+        if not improved:
+            break
+
+    for module, row in zip(modules, members):
+        module.cells = [cells[k] for k in row]
+        module.total_conductance = sum(table.conductance[c] for c in module.cells)
+    if verbose:
+        print(f"Weighted refinement: {swaps} swaps in {time.monotonic() - start:.2f} s, cost {initial:.6f} -> {current:.6f}")
+    return current
+
+def print_parameter_spreads(table: CellTable, modules: List[Module], names: List[str]):
+    parallel = len(modules[0].cells)
+    features = cell_features(table, [c for m in modules for c in m.cells], names, parallel)
+    sums = features.reshape(len(modules), parallel, len(names)).sum(axis=1)
+    spread = (sums.max(axis=0) - sums.min(axis=0)) / sums.mean(axis=0) * 100
+    print("\n--- Weighted Parameter Spreads ---")
+    for name, value in zip(names, spread):
+        print(f"{name + ':':<16}{value:.4f}%")
+
+# Inputs shared with restart worker processes, set once per process by _init_restart_worker().
+_restart_context = {}
+
+def _init_restart_worker(table: CellTable, pool: List[int], num_selected: int, series: int, parallel: int,
+                         algorithm: str, weights: Optional[Dict[str, float]], max_swaps: int):
+    _restart_context.update(table=table, pool=pool, num_selected=num_selected, series=series,
+                            parallel=parallel, algorithm=algorithm, weights=weights, max_swaps=max_swaps)
+
+def run_restart(seed: int):
+    """One randomized placement + refinement run, fully determined by seed.
+
+    The selected cells are ordered by conductance with kRestartJitter relative noise drawn
+    from the seed, grouped, and refined until no swap helps or max_swaps swaps have been made.
+    The cap rather than a time limit ends long runs, so a seed always gives the same result. Returns (score, seed, per-module
+    lists of cell indices), where score is the DCIR spread in Ohm, or the weighted cost when
+    weights are set.
+    """
+    ctx = _restart_context
+    table = ctx["table"]
+    rng = random.Random(seed)
+    cells = ctx["pool"][:ctx["num_selected"]]
+    spares = ctx["pool"][ctx["num_selected"]:]
+    cells.sort(key=lambda c: table.conductance[c] * (1 + rng.gauss(0, kRestartJitter)), reverse=True)
+
+    if ctx["algorithm"] == "kk":
+        modules = group_largest_differencing(table, cells, ctx["series"], ctx["parallel"])
+    else:
+        modules = group_greedy(table, cells, ctx["series"], ctx["parallel"])
+    if ctx["weights"]:
+        score = refine_weighted(table, modules, ctx["weights"], float("inf"), verbose=False, max_swaps=ctx["max_swaps"])
+    else:
+        refine_swaps(table, modules, float("inf"), spares, verbose=False, max_swaps=ctx["max_swaps"])
+        score = resistance_spread(modules)[0]
+
+    return score, seed, [m.cells for m in modules]
+
+def run_restarts(table: CellTable, pool: List[int], num_selected: int, series: int, parallel: int, algorithm: str,
+                 restarts: int, first_seed: int, workers: int, wall_clock: Optional[float],
+                 weights: Optional[Dict[str, float]] = None, max_swaps: Optional[int] = None):
+    """Runs seeds first_seed .. first_seed + restarts - 1 over a process pool, keeping the best.
+
+    Each run stops refining after max_swaps swaps (default kRestartSwapsPerModule per module),
+    which bounds how long a run takes. No new seeds are started once wall_clock seconds have
+    passed, so the budget can be overrun by at most the runs in flight, of which only a few are
+    kept per worker. The cells are sent
+    to each worker once as compact columns, and runs return only index lists, so throughput
+    scales with workers.
+    Returns (score, seed, modules) for the best run, or None if no run finished.
+    """
+    start = time.monotonic()
+    deadline = start + wall_clock if wall_clock else float("inf")
+    if max_swaps is None:
+        max_swaps = kRestartSwapsPerModule * (num_selected // parallel)
+    seeds = iter(range(first_seed, first_seed + restarts))
+    best = None
+    completed = 0
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_restart_worker,
+                             initargs=(table, pool, num_selected, series, parallel, algorithm, weights, max_swaps)) as executor:
+        pending = set()
+        while True:
+            while len(pending) < 2 * workers and time.monotonic() < deadline:
+                seed = next(seeds, None)
+                if seed is None:
+                    break
+                pending.add(executor.submit(run_restart, seed))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                completed += 1
+                if best is None or result[0] < best[0]:
+                    best = result
+
+    elapsed = time.monotonic() - start
+    print(f"Restarts: {completed} runs on {workers} workers in {elapsed:.2f} s ({completed / elapsed:.1f} runs/s)")
+    if best is None:
+        return None
+
+    score, seed, assignment = best
+    modules = []
+    for i, module_cells in enumerate(assignment):
+        total_conductance = sum(table.conductance[c] for c in module_cells)
+        modules.append(Module(id=i+1, cells=module_cells, total_conductance=total_conductance))
+    return score, seed, modules
+
+def assign_packs(modules: List[Module], packs: int) -> List[Module]:
+    """Deals balanced modules out to packs so the packs end up matched to each other.
+
+    The modules are sorted by resistance and dealt in snake order (1..K, K..1, ...), which keeps
+    each pack's series resistance close to the others. Module ids are renumbered 1..S within
+    each pack. Returns the modules ordered by pack, then id.
+    """
+    ordered = sorted(modules, key=lambda m: m.resistance)
+    by_pack = [[] for _ in range(packs)]
+    for i, module in enumerate(ordered):
+        lap, position = divmod(i, packs)
+        by_pack[position if lap % 2 == 0 else packs - 1 - position].append(module)
+
+    result = []
+    for pack, pack_modules in enumerate(by_pack):
+        for i, module in enumerate(pack_modules):
+            module.pack = pack + 1
+            module.id = i + 1
+            result.append(module)
+    return result
+
+def read_assignment(file_path: str, table: CellTable, row_of: Dict[str, int]) -> List[Module]:
+    """Loads a modules.csv written by write_output() back into Modules over table's rows.
+
+    row_of maps serial numbers to table rows.
+    """
+    modules = {}
+    try:
+        with open(file_path, mode='r', newline='', encoding='utf-8-sig') as f:
+            for line, row in enumerate(csv.DictReader(f)):
+                serial = row["Serial Number"]
+                if serial not in row_of:
+                    print(f"Error: {file_path} row {line+2}: serial {serial} is not in the input inventory")
+                    sys.exit(1)
+                key = (int(row.get("Pack ID") or 1), int(row["Module ID"]))
+                module = modules.setdefault(key, Module(id=key[1], pack=key[0]))
+                module.cells.append(row_of[serial])
+                module.total_conductance += table.conductance[row_of[serial]]
     except FileNotFoundError:
         print(f"Error: File not found: {file_path}")
         sys.exit(1)
-    except Exception as e:
-        print(f"Error reading file: {e}")
+    except (KeyError, ValueError) as e:
+        print(f"Error reading assignment: {e}")
         sys.exit(1)
-        
-    return cells
+    return list(modules.values())
+
+def _extremes_with(ordered: List[Module], changed: Dict[int, float]):
+    """(min, max) module conductance if the modules whose id() is in `changed` took those totals.
+
+    ordered is sorted by total conductance; since only a couple of modules change, the extremes
+    of the rest are found within the first few entries at either end.
+    """
+    lo = next((m.total_conductance for m in ordered if id(m) not in changed), None)
+    hi = next((m.total_conductance for m in reversed(ordered) if id(m) not in changed), None)
+    if lo is None: # Every module changed
+        return min(changed.values()), max(changed.values())
+    return min(lo, *changed.values()), max(hi, *changed.values())
+
+def replace_cell(table: CellTable, modules: List[Module], module: Module, rejected: int,
+                 unused: List[int], unused_keys: List[float], open_modules: List[Module]) -> str:
+    """Replaces a rejected cell in module with whatever leaves the lowest pack spread.
+
+    Candidates are a spare from the unused pool dropped straight into module, or a two-step
+    swap where module takes a cell from one of the open (not yet built) modules and that module
+    takes the spare. unused is sorted by conductance with unused_keys alongside, so every
+    candidate costs a binary search rather than a scan of the pool. Both lists are updated.
+    Returns a description of the change.
+    """
+    conductance = table.conductance
+    others = [m for m in modules if m is not module]
+    # With no other module to match, aim to keep the module where it was.
+    target = sum(m.total_conductance for m in others) / len(others) if others else module.total_conductance
+    rest = module.total_conductance - conductance[rejected]
+    ordered = sorted(modules, key=lambda m: m.total_conductance)
+
+    def nearest_spares(ideal):
+        j = bisect.bisect_left(unused_keys, ideal)
+        return [k for k in (j - 1, j) if 0 <= k < len(unused_keys)]
 
-def write_output(file_path: str, modules: List[Module], sort_input: bool):
+    def spread(lo_hi):
+        return 1.0 / lo_hi[0] - 1.0 / lo_hi[1]
+
+    # (spread, spare position, donor module or None, donor cell or None)
+    candidates = []
+    for k in nearest_spares(target - rest):
+        lo_hi = _extremes_with(ordered, {id(module): rest + unused_keys[k]})
+        candidates.append((spread(lo_hi), k, None, None))
+    for donor in open_modules:
+        if donor is module:
+            continue
+        for cell in donor.cells:
+            donor_rest = donor.total_conductance - conductance[cell]
+            for k in nearest_spares(target - donor_rest):
+                lo_hi = _extremes_with(ordered, {id(module): rest + conductance[cell],
+                                                 id(donor): donor_rest + unused_keys[k]})
+                candidates.append((spread(lo_hi), k, donor, cell))
+    if not candidates:
+        print("Error: no unused cells left to replace with")
+        sys.exit(1)
+
+    _, k, donor, donor_cell = min(candidates, key=lambda c: c[0])
+    spare = unused.pop(k)
+    unused_keys.pop(k)
+    position = module.cells.index(rejected)
+    if donor is None:
+        module.cells[position] = spare
+        module.total_conductance = rest + conductance[spare]
+        return f"{table.serial_numbers[spare]} replaces it"
+
+    module.cells[position] = donor_cell
+    module.total_conductance = rest + conductance[donor_cell]
+    donor.cells[donor.cells.index(donor_cell)] = spare
+    donor.total_conductance += conductance[spare] - conductance[donor_cell]
+    return (f"{table.serial_numbers[donor_cell]} moves in from pack {donor.pack} module {donor.id}, "
+            f"{table.serial_numbers[spare]} takes its place")
+
+def regroup(args, table: CellTable):
+    """Incremental mode: swaps rejected cells out of an existing assignment."""
+    start = time.monotonic()
+    row_of = {serial: i for i, serial in enumerate(table.serial_numbers)}
+    modules = read_assignment(args.assignment, table, row_of)
+
+    assigned = set(c for m in modules for c in m.cells)
+    rejected = []
+    for serial in args.reject:
+        if serial not in row_of:
+            print(f"Error: rejected serial {serial} is not in the input inventory")
+            sys.exit(1)
+        if row_of[serial] not in rejected:
+            rejected.append(row_of[serial])
+    unused = sorted((i for i in range(len(table)) if i not in assigned and i not in rejected),
+                    key=table.conductance.__getitem__)
+    unused_keys = [table.conductance[i] for i in unused]
+
+    known_keys = set((m.pack, m.id) for m in modules)
+    open_keys = set()
+    for item in (args.unfinished or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        pack, _, module_id = item.rpartition(":")
+        try:
+            key = (int(pack or 1), int(module_id))
+        except ValueError:
+            print(f"Error: unfinished module '{item}' is not a MODULE or PACK:MODULE number")
+            sys.exit(1)
+        if key not in known_keys:
+            print(f"Error: unfinished module '{item}' is not in {args.assignment}")
+            sys.exit(1)
+        open_keys.add(key)
+    open_modules = [m for m in modules if (m.pack, m.id) in open_keys]
+
+    indexed = time.monotonic()
+    before = resistance_spread(modules)
+    for cell in rejected:
+        module = next((m for m in modules if cell in m.cells), None)
+        if module is None:
+            print(f"{table.serial_numbers[cell]} is not assigned, nothing to replace")
+            continue
+        change = replace_cell(table, modules, module, cell, unused, unused_keys, open_modules)
+        print(f"Rejected {table.serial_numbers[cell]} in pack {module.pack} module {module.id}: {change}")
+
+    after = resistance_spread(modules)
+    print(f"Spread {before[0]:.6f} Ohm ({before[1]:.4f}%) -> {after[0]:.6f} Ohm ({after[1]:.4f}%), "
+          f"chosen in {(time.monotonic() - indexed) * 1000:.1f} ms after {(indexed - start) * 1000:.0f} ms indexing the pool")
+
+    packs = max(m.pack for m in modules)
+    write_output(args.output, table, modules, args.sort_input, packs)
+    print_stats(modules)
+    if packs > 1:
+        print_pack_stats(modules, packs)
+
+def _subset_overshoot_bound(values: List[float], parallel: int, target: float, deadline: float):
+    """Lower bound on (s - target) over every sum s >= target of `parallel` distinct values.
+
+    Branch-and-bound over values sorted in descending order. Each stack entry is an unexplored
+    subtree, so if the deadline passes the smallest bound among them (and the best sum found)
+    is still a valid lower bound. Returns (bound, True if the search finished).
+    """
+    n = len(values)
+    prefix = list(itertools.accumulate(values, initial=0.0))
+    best = float("inf")
+    # (next index, cells chosen, running sum, lower bound of the subtree)
+    stack = [(0, 0, 0.0, 0.0)]
+    while stack:
+        if time.monotonic() >= deadline:
+            return min(best, min(node[3] for node in stack)), False
+        i, chosen, total, node_bound = stack.pop()
+        if node_bound >= best:
+            continue
+        remaining = parallel - chosen
+        if remaining == 0:
+            if total >= target:
+                best = min(best, total - target)
+            continue
+        if i + remaining > n:
+            continue
+        # The largest and smallest completions take the next / last `remaining` values.
+        largest = total + prefix[i + remaining] - prefix[i]
+        smallest = total + prefix[n] - prefix[n - remaining]
+        if largest < target:
+            continue
+        bound = max(0.0, smallest - target)
+        if bound >= best:
+            continue
+        stack.append((i + 1, chosen, total, bound))
+        stack.append((i + 1, chosen + 1, total + values[i], bound))
+    return best, True
+
+# The overshoots shrink as the number of possible modules grows. Beyond this many ways to pick a
+# module's cells, the bound is indistinguishable from zero and the search cannot finish anyway.
+kBoundMaxSubsets = 10**8
+
+def spread_lower_bound(table: CellTable, cells: List[int], series: int, parallel: int, time_limit: float):
+    """Proven lower bound on the module resistance spread achievable with these cells.
+
+    The mean module conductance T is fixed by the cells, so the highest module sits at or
+    above T and the lowest at or below it. Both are sums of `parallel` cells, so the highest
+    is at least T plus the smallest overshoot any such sum can have, and likewise for the
+    lowest. The two overshoots are bounded by a branch-and-bound sharing time_limit seconds.
+    Only useful for small packs: see kBoundMaxSubsets. Returns (bound in Ohm, True if both searches finished).
+    """
+    conductances = sorted((table.conductance[c] for c in cells), reverse=True)
+    target = sum(conductances) / series
+    deadline = time.monotonic() + time_limit / 2
+    over, over_done = _subset_overshoot_bound(conductances, parallel, target, deadline)
+    deadline = time.monotonic() + time_limit / 2
+    under, under_done = _subset_overshoot_bound([-g for g in reversed(conductances)], parallel, -target, deadline)
+    return 1.0 / (target - under) - 1.0 / (target + over), over_done and under_done
+
+def write_output(file_path: str, table: CellTable, modules: List[Module], sort_input: bool, packs: int = 1):
     try:
         with open(file_path, mode='w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
-            writer.writerow(["Module ID", "Serial Number", "Cell DCIR (Ohm)", "Module Parallel DCIR (Ohm)"])
+            # The pack column only appears for multi-pack runs, so single-pack output is unchanged.
+            pack_header = ["Pack ID"] if packs > 1 else []
+            writer.writerow(pack_header + ["Module ID", "Serial Number", "Cell DCIR (Ohm)", "Module Parallel DCIR (Ohm)"])
             
             # Collect all rows first
             rows = []
             for mod in modules:
                 mod_res = mod.resistance
+                pack_column = [mod.pack] if packs > 1 else []
                 for cell in mod.cells:
                     rows.append({
-                        "row": [mod.id, cell.serial_number, f"{cell.dcir:.6f}", f"{mod_res:.6f}"],
-                        "original_index": cell.original_index
+                        "row": pack_column + [mod.id, table.serial_numbers[cell], f"{table.dcir[cell]:.6f}", f"{mod_res:.6f}"],
+                        "original_index": table.original_index[cell]
                     })
             
             # Sort if requested
@@ -81,74 +914,249 @@ def write_output(file_path: str, modules: List[Module], sort_input: bool):
         print(f"Error writing output: {e}")
         sys.exit(1)
 
-def print_stats(modules: List[Module]):
+def print_stats(modules: List[Module], lower_bound: Optional[float] = None, bound_proven: bool = False):
     resistances = [m.resistance for m in modules]
     min_res = min(resistances)
     max_res = max(resistances)
     avg_res = sum(resistances) / len(resistances)
-    diff = max_res - min_res
-    percent_diff = (diff / avg_res) * 100 if avg_res > 0 else 0
+    diff, percent_diff = resistance_spread(modules)
 
     print("\n--- Module Statistics ---")
     print(f"Min Resistance: {min_res:.6f} Ohm")
     print(f"Max Resistance: {max_res:.6f} Ohm")
     print(f"Avg Resistance: {avg_res:.6f} Ohm")
     print(f"Spread:         {diff:.6f} Ohm ({percent_diff:.4f}%)")
+    if lower_bound is not None and (bound_proven or lower_bound > 0):
+        gap = max(0.0, diff - lower_bound)
+        search = "search complete" if bound_proven else "search timed out"
+        print(f"Lower Bound:    {lower_bound:.9f} Ohm ({search})")
+        print(f"Optimality Gap: {gap:.9f} Ohm ({gap / avg_res * 100:.4f}%)")
+    elif lower_bound is not None:
+        print("Lower Bound:    none found before the search timed out")
+
+def print_pack_stats(modules: List[Module], packs: int):
+    pack_resistances = []
+    print("\n--- Pack Statistics ---")
+    for pack in range(1, packs + 1):
+        pack_modules = [m for m in modules if m.pack == pack]
+        pack_resistance = sum(m.resistance for m in pack_modules)
+        pack_resistances.append(pack_resistance)
+        diff, percent_diff = resistance_spread(pack_modules)
+        print(f"Pack {pack}: {pack_resistance:.6f} Ohm, module spread {diff:.6f} Ohm ({percent_diff:.4f}%)")
+    avg_res = sum(pack_resistances) / packs
+    diff = max(pack_resistances) - min(pack_resistances)
+    print(f"Pack-to-pack spread: {diff:.6f} Ohm ({diff / avg_res * 100:.4f}%)")
 
 def main():
     parser = argparse.ArgumentParser(description="Group battery cells into modules with balanced parallel resistance.")
-    parser.add_argument("--input", required=True, help="Path to input CSV file")
-    parser.add_argument("--series", type=int, required=True, help="Number of cells in series (number of modules)")
-    parser.add_argument("--parallel", type=int, required=True, help="Number of cells in parallel per module")
+    parser.add_argument("--input", nargs="+",
+                        help="Path to input CSV file, or several test logs (e.g. one per station) in the order they were recorded")
+    parser.add_argument("--retest-policy", choices=["latest", "median", "reject"], default="latest",
+                        help="How to resolve cells that appear more than once: keep the latest row, use the median "
+                             "of each parameter, or reject the cell when its DCIR readings disagree")
+    parser.add_argument("--retest-tolerance", type=float, default=2.0,
+                        help="With --retest-policy reject, the allowed DCIR disagreement in percent of the median")
+    parser.add_argument("--database", default=None,
+                        help="Read cells from the SQLite cell database (see testing/cell/cell_database.py) instead of --input")
+    parser.add_argument("--since", default=None, help="With --database, only use tests at or after this time, e.g. 2025-06-01")
+    parser.add_argument("--until", default=None, help="With --database, only use tests before this time")
+    parser.add_argument("--station", default=None, help="With --database, only use tests from this station")
+    parser.add_argument("--series", type=int, help="Number of cells in series (number of modules)")
+    parser.add_argument("--parallel", type=int, help="Number of cells in parallel per module")
+    parser.add_argument("--packs", type=int, default=1,
+                        help="Number of packs to build from the inventory in one pass, matched to each other")
     parser.add_argument("--output", default="modules.csv", help="Path to output CSV file")
     parser.add_argument("--sort-input", action="store_true", help="Sort output by original input order instead of by module")
+    parser.add_argument("--algorithm", choices=["greedy", "kk"], default="greedy",
+                        help="Grouping algorithm: greedy best-fit, or kk for balanced largest differencing (Karmarkar-Karp)")
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="Seconds of pairwise-swap refinement after grouping (default: 10 for kk or with --skips, 0 otherwise)")
+    parser.add_argument("--selection", choices=["middle", "window"], default="middle",
+                        help="Cell selection: the middle of the DCIR-sorted list, or the window whose cells span the narrowest "
+                             "conductance range. The narrowest range does not always give the lowest spread")
+    parser.add_argument("--bound-seconds", type=float, default=0.0,
+                        help="Time limit for a search for a lower bound on the spread, reported with the optimality gap "
+                             "(default: 0, no search). Only small packs get a useful bound; at inventory scale, such as "
+                             "32s9p, the search is skipped and no gap is reported")
+    parser.add_argument("--gap-tolerance", type=float, default=0.0,
+                        help="Stop refinement once the optimality gap is at or below this percentage of the average module resistance "
+                             "(needs --bound-seconds)")
+    parser.add_argument("--weights", default=None,
+                        help="Balance a weighted mix of parameters during refinement, e.g. dcir=1,r0=0.5,ocv=0.2 "
+                             f"(available: {', '.join(kParameters)}, the fit_ ones from testing/cell/fit_traces.py; requires numpy)")
+    parser.add_argument("--restarts", type=int, default=0,
+                        help="Number of seeded randomized placement and refinement runs to try in parallel, keeping the best")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes for --restarts (default: CPU count)")
+    parser.add_argument("--seed", type=int, default=0, help="First seed for --restarts; --restarts 1 --seed N reproduces run N")
+    parser.add_argument("--wall-clock", type=float, default=None,
+                        help="Stop starting new restarts after this many seconds (default: run them all)")
+    parser.add_argument("--restart-swaps", type=int, default=None,
+                        help=f"Refinement swaps each restart may make (default: {kRestartSwapsPerModule} per module)")
+    parser.add_argument("--skips", type=int, default=0,
+                        help="With --selection window, widen the window by this many spare cells that refinement may leave out")
+    parser.add_argument("--assignment", default=None,
+                        help="Existing modules.csv to patch incrementally instead of grouping from scratch")
+    parser.add_argument("--reject", action="append", default=[],
+                        help="With --assignment, serial number of a cell to swap out (repeatable)")
+    parser.add_argument("--unfinished", default=None,
+                        help="With --assignment, comma-separated module IDs (PACK:MODULE for multi-pack) not yet built, "
+                             "which may give up a cell; all other modules stay as they are")
     
     args = parser.parse_args()
+    if (args.input is None) == (args.database is None):
+        parser.error("exactly one of --input and --database is required")
+    if not args.assignment and (args.series is None or args.parallel is None):
+        parser.error("--series and --parallel are required unless --assignment is given")
+    if args.gap_tolerance > 0 and args.bound_seconds <= 0:
+        parser.error("--gap-tolerance needs a lower bound to measure the gap against; pass --bound-seconds")
+    if args.restart_swaps is not None and args.restart_swaps < 1:
+        parser.error("--restart-swaps must be at least 1")
+
+    weights = None
+    if args.weights:
+        if np is None:
+            print("Error: --weights requires numpy (pip install numpy)")
+            sys.exit(1)
+        try:
+            weights = parse_weights(args.weights)
+        except ValueError as e:
+            print(f"Error: invalid --weights: {e}")
+            sys.exit(1)
+        if args.skips:
+            print("Error: --weights cannot be combined with --skips")
+            sys.exit(1)
 
     # 1. Read CSV
-    cells = read_cells(args.input)
+    if args.database:
+        table = read_database(args.database, args.since, args.until, args.station, args.retest_policy, args.retest_tolerance)
+    else:
+        table = read_cells(args.input, args.retest_policy, args.retest_tolerance)
+
+    if args.assignment:
+        regroup(args, table)
+        return
     
-    total_needed = args.series * args.parallel
-    if len(cells) < total_needed:
-        print(f"Error: Not enough cells! Have {len(cells)}, need {total_needed}")
+    # Every module of every pack is balanced in one pass; assign_packs() splits them up at the end.
+    series = args.series * args.packs
+    total_needed = series * args.parallel
+    if len(table) < total_needed:
+        print(f"Error: Not enough cells! Have {len(table)}, need {total_needed}")
         sys.exit(1)
 
     # 2. Filter and Sort Cells
-    # Sort by DCIR and pick the middle chunk to avoid outliers.
-    cells.sort(key=lambda c: c.dcir)
+    # Sort by DCIR and pick the middle chunk to avoid outliers. Cells are row indices from here on.
+    cells = sorted(range(len(table)), key=table.dcir.__getitem__)
     
     excess = len(cells) - total_needed
     start_index = excess // 2
-    selected_cells = cells[start_index : start_index + total_needed]
+    span = total_needed
+    spares = []
+
+    if args.selection == "window":
+        if args.skips < 0 or args.skips > excess:
+            print(f"Error: --skips must be between 0 and {excess}")
+            sys.exit(1)
+        start_index, span, score, middle_score = select_window(table, cells, total_needed, args.parallel, args.skips)
+        # Not an achievable spread: the grouping usually ends far below the cells' own range.
+        print(f"Window score (cell conductance range / module conductance): {score * 100:.4f}% for the best window, "
+              f"{middle_score * 100:.4f}% for the middle")
+
+        # Group the middle of the window and hand the cells at its edges to the refinement.
+        offset = start_index + args.skips // 2
+        spares = cells[start_index:offset] + cells[offset + total_needed:start_index + span]
+        selected_cells = cells[offset : offset + total_needed]
+    else:
+        selected_cells = cells[start_index : start_index + total_needed]
     
-    print(f"Selected {len(selected_cells)} cells from {len(cells)} available (skipped {start_index} low and {excess - start_index} high outliers)")
+    print(f"Selected {len(selected_cells)} cells from {len(cells)} available (skipped {start_index} low and {excess - start_index - (span - total_needed)} high outliers, {len(spares)} spares)")
 
-    # 3. Grouping Algorithm (Greedy Best-Fit)
+    # 3. Grouping Algorithm
     # Sort selected cells by Conductance descending (highest current capability first)
-    selected_cells.sort(key=lambda c: c.conductance, reverse=True)
-
-    modules = [Module(id=i+1) for i in range(args.series)]
-
-    # Distribute cells
-    for cell in selected_cells:
-        # Find the module with the lowest total conductance that isn't full
-        # We filter for non-full modules, then find min by total_conductance
-        eligible_modules = [m for m in modules if len(m.cells) < args.parallel]
-        
-        if not eligible_modules:
-             print(f"Error: Algorithm error, no eligible modules for cell {cell.serial_number}")
-             sys.exit(1)
-
-        best_module = min(eligible_modules, key=lambda m: m.total_conductance)
-        
-        best_module.cells.append(cell)
-        best_module.total_conductance += cell.conductance
+    selected_cells.sort(key=table.conductance.__getitem__, reverse=True)
+
+    if weights:
+        candidates = selected_cells + spares
+        missing = [name for name in weights if any(math.isnan(table.column(name)[c]) for c in candidates)]
+        if missing:
+            print(f"Error: selected cells are missing values for: {', '.join(missing)}")
+            sys.exit(1)
+        # Resistances are balanced as conductances, so they must be positive.
+        invalid = [name for name in weights if name not in kAveragedParameters and any(not table.column(name)[c] > 0 for c in candidates)]
+        if invalid:
+            print(f"Error: selected cells have non-positive values for: {', '.join(invalid)}")
+            sys.exit(1)
+
+    if args.algorithm == "kk":
+        modules = group_largest_differencing(table, selected_cells, series, args.parallel)
+    else:
+        modules = group_greedy(table, selected_cells, series, args.parallel)
+
+    time_budget = args.time_budget
+    if time_budget is None:
+        time_budget = 10.0 if args.algorithm == "kk" or spares or weights else 0.0
+
+    bound_seconds = args.bound_seconds
+    subsets = math.comb(len(selected_cells), args.parallel)
+    if bound_seconds > 0 and subsets > kBoundMaxSubsets:
+        print(f"Lower bound skipped: with {subsets:.1e} ways to pick {args.parallel} of {len(selected_cells)} cells, "
+              "the bound is effectively zero, so no optimality gap is available at this size")
+        if args.gap_tolerance > 0:
+            print("Warning: --gap-tolerance has no bound to work with and is ignored")
+        bound_seconds = 0.0
+
+    # Spares can change which cells end up grouped, so the bound is only known upfront without them.
+    lower_bound, bound_proven = None, False
+    if bound_seconds > 0 and not spares:
+        lower_bound, bound_proven = spread_lower_bound(table, selected_cells, series, args.parallel, bound_seconds)
+
+    score = resistance_spread(modules)[0]
+    if time_budget > 0 and weights:
+        score = refine_weighted(table, modules, weights, time_budget)
+    elif time_budget > 0:
+        diff, percent_diff = resistance_spread(modules)
+        print(f"Initial {args.algorithm} spread: {diff:.6f} Ohm ({percent_diff:.4f}%)")
+        stop_spread = 0.0
+        if lower_bound is not None and args.gap_tolerance > 0 and not bound_proven and lower_bound <= 0:
+            print("Warning: the bound search timed out without a bound, so --gap-tolerance cannot stop refinement early")
+        elif lower_bound is not None:
+            avg_res = sum(m.resistance for m in modules) / len(modules)
+            stop_spread = lower_bound + args.gap_tolerance / 100 * avg_res
+        refine_swaps(table, modules, time_budget, spares, stop_spread)
+        score = resistance_spread(modules)[0]
+    elif weights:
+        score = refine_weighted(table, modules, weights, 0.0, verbose=False)
+
+    if args.restarts > 0:
+        pool = selected_cells + spares
+        result = run_restarts(table, pool, len(selected_cells), series, args.parallel, args.algorithm,
+                              args.restarts, args.seed, args.workers, args.wall_clock, weights,
+                              args.restart_swaps)
+        if result is not None:
+            restart_score, seed, restart_modules = result
+            diff, percent_diff = resistance_spread(restart_modules)
+            cost = f", weighted cost {restart_score:.6f}" if weights else ""
+            print(f"Best restart: seed {seed}, spread {diff:.9f} Ohm ({percent_diff:.4f}%){cost}, reproduce with --restarts 1 --seed {seed}")
+            if restart_score < score:
+                modules = restart_modules
+                grouped = set(c for m in modules for c in m.cells)
+                spares = [cell for cell in pool if cell not in grouped]
+
+    if bound_seconds > 0 and spares:
+        grouped = [cell for m in modules for cell in m.cells]
+        lower_bound, bound_proven = spread_lower_bound(table, grouped, series, args.parallel, bound_seconds)
+
+    if args.packs > 1:
+        modules = assign_packs(modules, args.packs)
 
     # 4. Write Output
-    write_output(args.output, modules, args.sort_input)
+    write_output(args.output, table, modules, args.sort_input, args.packs)
     
     # Print stats
-    print_stats(modules)
+    print_stats(modules, lower_bound, bound_proven)
+    if args.packs > 1:
+        print_pack_stats(modules, args.packs)
+    if weights:
+        print_parameter_spreads(table, modules, list(weights))
 
 if __name__ == "__main__":
     main()
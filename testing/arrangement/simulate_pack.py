@@ -0,0 +1,219 @@
+import argparse
+import csv
+import random
+import sys
+import time
+
+import numpy as np
+
+import group_cells
+
+# Electrical parameters of the module hardware.
+kCellTab_ohms = 0.0005 # Nickel insert and welds between one cell and the bus bars
+kBusbarSegment_ohms = 0.00005 # Bus bar between adjacent cells of a parallel group
+kInterconnect_ohms = 0.0001 # Bus bar between adjacent modules of the series string
+kNominalOcv_volts = 3.6 # Used for cells without an OCV measurement
+kLoadCurrent_amps = 30.0 # Constant pack discharge current when no profile is given
+
+# Parallel groups solved per np.linalg.solve call; bounds memory when scoring many candidates.
+kSolveChunk = 65536
+
+class LoadProfile:
+    """Piecewise-constant pack current; positive is discharge. Sample k holds until sample k+1."""
+    def __init__(self, times, currents):
+        self.currents = np.asarray(currents, dtype=float)
+        self.durations = np.diff(np.asarray(times, dtype=float), append=times[-1])
+        if np.any(self.durations < 0):
+            raise ValueError("profile times must be increasing")
+
+    @classmethod
+    def constant(cls, current):
+        return cls([0.0, 1.0], [current, current])
+
+    @classmethod
+    def read(cls, file_path):
+        """Reads a CSV with "Time (s)" and "Current (A)" columns."""
+        times, currents = [], []
+        with open(file_path, mode='r', newline='', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                times.append(float(row["Time (s)"]))
+                currents.append(float(row["Current (A)"]))
+        if not times:
+            raise ValueError(f"{file_path} has no samples")
+        return cls(times, currents)
+
+def busbar_transfer(parallel, opposite_terminals):
+    """Bus bar drop seen by each cell per amp from each other cell, in bus bar segments.
+
+    Cell m's current runs along the positive bar from m to the terminal at cell 0, and along
+    the negative bar from the negative terminal to m. Entry (k, m) counts the segments that
+    path shares with cell k's own path.
+    """
+    cells = np.arange(parallel)
+    positive = np.minimum.outer(cells, cells)
+    negative_distance = parallel - 1 - cells if opposite_terminals else cells
+    return positive + np.minimum.outer(negative_distance, negative_distance)
+
+def _unit_responses(ocv, resistance, tab, segment, opposite_terminals):
+    """Solves every parallel group for its rest (zero load) and per-amp load responses.
+
+    ocv and resistance have shape (..., parallel). Each cell is a Thevenin source whose tab
+    connects to a positive and a negative bus bar, with `segment` Ohms of bar between
+    neighbouring cells. The load leaves the positive bar at cell 0 and returns on the negative
+    bar at the last cell (opposite_terminals) or at cell 0. With the bars folded into
+    busbar_transfer(), each group is a bordered system in its cell currents i and terminal
+    voltage V:
+
+        (diag(R + tab) + segment * M) i + V = OCV,    sum(i) = load
+
+    Returns the cell currents and terminal voltage as (rest, per_amp) pairs, since the network
+    is linear in the load current.
+    """
+    parallel = ocv.shape[-1]
+    size = parallel + 1
+    border = np.zeros((size, size))
+    border[:parallel, :parallel] = segment * busbar_transfer(parallel, opposite_terminals)
+    border[:parallel, parallel] = 1.0
+    border[parallel, :parallel] = 1.0
+    diagonal = np.arange(parallel)
+
+    flat_ocv = ocv.reshape(-1, parallel)
+    flat_resistance = resistance.reshape(-1, parallel) + tab
+    solution = np.empty((len(flat_ocv), size, 2))
+    for start in range(0, len(flat_ocv), kSolveChunk):
+        chunk = slice(start, start + kSolveChunk)
+        matrix = np.repeat(border[None], len(flat_ocv[chunk]), axis=0)
+        matrix[:, diagonal, diagonal] += flat_resistance[chunk]
+        # Column 0: the cells' own EMFs with no load. Column 1: one amp drawn from the terminals.
+        rhs = np.zeros((len(matrix), size, 2))
+        rhs[:, :parallel, 0] = flat_ocv[chunk]
+        rhs[:, parallel, 1] = 1.0
+        solution[chunk] = np.linalg.solve(matrix, rhs)
+
+    shape = ocv.shape
+    currents = solution[:, :parallel]
+    voltages = solution[:, parallel]
+    return ((currents[..., 0].reshape(shape), currents[..., 1].reshape(shape)),
+            (voltages[:, 0].reshape(shape[:-1]), voltages[:, 1].reshape(shape[:-1])))
+
+def simulate(ocv, resistance, profile, tab=kCellTab_ohms, segment=kBusbarSegment_ohms,
+             interconnect=kInterconnect_ohms, opposite_terminals=True):
+    """Simulates a batch of candidate packs over a load profile.
+
+    ocv and resistance have shape (candidates, series, parallel). Returns a dict of arrays:
+    per-cell peak current and heat (W) at the profile's extreme currents, per-cell energy (J)
+    over the profile, per-module terminal voltage at peak load, and per-candidate scores:
+    the worst in-group current imbalance, the module voltage mismatch under peak load, and
+    the pack voltage under peak load.
+    """
+    (i_rest, i_amp), (v_rest, v_amp) = _unit_responses(ocv, resistance, tab, segment, opposite_terminals)
+    series, parallel = ocv.shape[-2], ocv.shape[-1]
+
+    # Currents are linear in the load, so their extremes fall on the profile's extremes and the
+    # energy is a quadratic in the profile's current moments.
+    extremes = np.array([profile.currents.min(), profile.currents.max()])
+    peak_load = extremes[np.argmax(np.abs(extremes))]
+    cell_currents = i_rest[..., None] + i_amp[..., None] * extremes
+    peak_current = np.max(np.abs(cell_currents), axis=-1)
+    moments = [profile.durations.sum(), (profile.durations * profile.currents).sum(),
+               (profile.durations * profile.currents ** 2).sum()]
+    energy = (i_rest ** 2 * moments[0] + 2 * i_rest * i_amp * moments[1] + i_amp ** 2 * moments[2]) * resistance
+
+    loaded = i_rest + i_amp * peak_load
+    share = abs(peak_load) / parallel if peak_load else 1.0
+    imbalance = (loaded.max(axis=-1) - loaded.min(axis=-1)) / share
+    module_voltage = v_rest + v_amp * peak_load
+    return {
+        "peak_current": peak_current,
+        "peak_heat": peak_current ** 2 * resistance,
+        "energy": energy,
+        "module_voltage": module_voltage,
+        "imbalance": imbalance,
+        "worst_imbalance": imbalance.max(axis=-1),
+        "voltage_mismatch": module_voltage.max(axis=-1) - module_voltage.min(axis=-1),
+        "pack_voltage": module_voltage.sum(axis=-1) - peak_load * interconnect * (series - 1),
+    }
+
+def pack_arrays(table, groupings):
+    """Builds (candidates, series, parallel) OCV and DCIR arrays from lists of per-module cell rows."""
+    rows = np.array(groupings, dtype=np.int64)
+    ocv = np.frombuffer(table.ocv, dtype=np.float64)[rows]
+    ocv = np.where(np.isnan(ocv), kNominalOcv_volts, ocv)
+    resistance = np.frombuffer(table.dcir, dtype=np.float64)[rows]
+    return ocv, resistance
+
+def random_swaps(groupings, count, rng):
+    """Returns count copies of a grouping, each with one random pair of cells swapped between modules."""
+    candidates = []
+    series = len(groupings)
+    for _ in range(count):
+        candidate = [list(cells) for cells in groupings]
+        a, b = rng.sample(range(series), 2)
+        i, j = rng.randrange(len(candidate[a])), rng.randrange(len(candidate[b]))
+        candidate[a][i], candidate[b][j] = candidate[b][j], candidate[a][i]
+        candidates.append(candidate)
+    return candidates
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate current sharing and heating in a grouped pack.")
+    parser.add_argument("--assignment", default="modules.csv", help="modules.csv written by group_cells.py")
+    parser.add_argument("--input", default=["cell_data.csv"], nargs="+", help="Cell test CSVs the assignment was made from (for OCV)")
+    parser.add_argument("--profile", default=None,
+                        help="CSV load profile with Time (s) and Current (A) columns, discharge positive "
+                             f"(default: a constant {kLoadCurrent_amps} A)")
+    parser.add_argument("--current", type=float, default=kLoadCurrent_amps, help="Constant pack current when no profile is given")
+    parser.add_argument("--tab-resistance", type=float, default=kCellTab_ohms, help="Ohms between each cell and the bus bars")
+    parser.add_argument("--busbar-resistance", type=float, default=kBusbarSegment_ohms, help="Ohms of bus bar between adjacent cells")
+    parser.add_argument("--interconnect-resistance", type=float, default=kInterconnect_ohms, help="Ohms between adjacent modules")
+    parser.add_argument("--terminals", choices=["opposite", "same"], default="opposite",
+                        help="Whether a module's positive and negative connections are at opposite ends of the group or the same end")
+    parser.add_argument("--candidates", type=int, default=0,
+                        help="Also score this many random single-swap variants of the assignment in one batch")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for --candidates")
+    args = parser.parse_args()
+
+    table = group_cells.read_cells(args.input)
+    row_of = {serial: i for i, serial in enumerate(table.serial_numbers)}
+    modules = group_cells.read_assignment(args.assignment, table, row_of)
+    packs = sorted(set(m.pack for m in modules))
+    # One candidate per pack, each an ordered list of modules.
+    groupings = [[m.cells for m in sorted((m for m in modules if m.pack == pack), key=lambda m: m.id)] for pack in packs]
+    if len(set(len(cells) for pack in groupings for cells in pack)) != 1 or len(set(len(pack) for pack in groupings)) != 1:
+        print("Error: every pack needs the same number of modules and every module the same number of cells")
+        sys.exit(1)
+
+    try:
+        profile = LoadProfile.read(args.profile) if args.profile else LoadProfile.constant(args.current)
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Error reading profile: {e}")
+        sys.exit(1)
+    options = dict(tab=args.tab_resistance, segment=args.busbar_resistance, interconnect=args.interconnect_resistance,
+                   opposite_terminals=args.terminals == "opposite")
+
+    result = simulate(*pack_arrays(table, groupings), profile, **options)
+    for p, pack in enumerate(packs):
+        print(f"\n--- Pack {pack} ---")
+        print("Module  Voltage (V)  Imbalance  Hottest cell  Peak (A)  Heat (W)  Energy (J)")
+        for s, cells in enumerate(groupings[p]):
+            k = int(np.argmax(result["peak_heat"][p, s]))
+            print(f"{s + 1:>6}  {result['module_voltage'][p, s]:11.4f}  {result['imbalance'][p, s] * 100:8.3f}%  "
+                  f"{table.serial_numbers[cells[k]]:>12}  {result['peak_current'][p, s, k]:8.3f}  "
+                  f"{result['peak_heat'][p, s, k]:8.4f}  {result['energy'][p, s, k]:10.2f}")
+        print(f"Worst current imbalance:   {result['worst_imbalance'][p] * 100:.3f}% of the even share")
+        print(f"Module voltage mismatch:   {result['voltage_mismatch'][p] * 1000:.3f} mV under peak load")
+        print(f"Pack voltage:              {result['pack_voltage'][p]:.3f} V under peak load")
+        print(f"Peak cell heat:            {result['peak_heat'][p].max():.4f} W")
+
+    if args.candidates:
+        rng = random.Random(args.seed)
+        candidates = random_swaps(groupings[0], args.candidates, rng)
+        start = time.perf_counter()
+        scores = simulate(*pack_arrays(table, candidates), profile, **options)["worst_imbalance"]
+        elapsed = time.perf_counter() - start
+        better = int(np.sum(scores < result["worst_imbalance"][0]))
+        print(f"\nScored {args.candidates} single-swap candidates of pack {packs[0]} in {elapsed:.3f} s "
+              f"({args.candidates / elapsed:.0f}/s); {better} reduce the worst current imbalance, "
+              f"best {scores.min() * 100:.3f}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import argparse
+import csv
+import math
+import os
+import sqlite3
+import sys
+import time
+
+# Measurement columns, keyed by the CSV header written by test_cells.py.
+kColumns = {
+    "OCV (V)": "ocv",
+    "R0 (Ohm)": "r0",
+    "R0 Charge (Ohm)": "r0_charge",
+    "R0 Discharge (Ohm)": "r0_discharge",
+    "DCIR (Ohm)": "dcir",
+    "DCIR Charge (Ohm)": "dcir_charge",
+    "DCIR Discharge (Ohm)": "dcir_discharge",
+}
+
+kInsertBatchSize = 5000 # Rows per transaction when importing CSVs
+kBusyTimeout_seconds = 30.0 # How long a writer waits for another station's transaction to finish
+kTimeFormat = "%Y-%m-%d %H:%M:%S"
+kCacheSize_kilobytes = 256 * 1024
+
+kIndexedColumns = ("serial", "tested_at", "station") + tuple(kColumns.values())
+
+class CellDatabase:
+    """SQLite store for cell test results, shared by test_cells.py and group_cells.py.
+
+    Every test is a row in `measurements`, so retests are kept rather than overwritten. The
+    database runs in WAL mode so several stations can append while another tool reads, and
+    serial number, test time, station and every measured parameter are indexed.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=kBusyTimeout_seconds)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL") # Durable in WAL mode, without a sync per commit
+        self.conn.execute(f"PRAGMA cache_size=-{kCacheSize_kilobytes}") # Keeps index pages resident during bulk imports
+        parameters = ", ".join(f"{name} REAL" for name in kColumns.values())
+        with self.conn:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS measurements ("
+                              f"id INTEGER PRIMARY KEY, serial TEXT NOT NULL, tested_at TEXT NOT NULL, station TEXT, {parameters})")
+        self.create_indexes()
+
+    def create_indexes(self):
+        with self.conn:
+            for name in kIndexedColumns:
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS measurements_{name} ON measurements ({name})")
+
+    def drop_indexes(self):
+        with self.conn:
+            for name in kIndexedColumns:
+                self.conn.execute(f"DROP INDEX IF EXISTS measurements_{name}")
+
+    def close(self):
+        self.conn.close()
+
+    def insert(self, results, station=None, tested_at=None):
+        """Inserts an iterable of test_cells.py result dicts in a single transaction."""
+        tested_at = tested_at or time.strftime(kTimeFormat)
+        rows = ((r["Serial Number"], tested_at, station) + tuple(_to_float(r.get(header)) for header in kColumns)
+                for r in results)
+        placeholders = ", ".join("?" * (3 + len(kColumns)))
+        with self.conn:
+            self.conn.executemany(f"INSERT INTO measurements (serial, tested_at, station, {', '.join(kColumns.values())}) "
+                                  f"VALUES ({placeholders})", rows)
+
+    def import_csv(self, file_path, station=None, tested_at=None):
+        """Imports a test_cells.py CSV in batches. Returns the number of rows imported.
+
+        The CSV has no test times, so rows are stamped with the file's modification time unless
+        tested_at is given.
+        """
+        tested_at = tested_at or time.strftime(kTimeFormat, time.localtime(os.path.getmtime(file_path)))
+        # Loading into an empty database is much faster with the indexes built once at the end.
+        bulk = self.conn.execute("SELECT NOT EXISTS (SELECT 1 FROM measurements)").fetchone()[0]
+        if bulk:
+            self.drop_indexes()
+        count = 0
+        try:
+            with open(file_path, mode='r', newline='', encoding='utf-8-sig') as f:
+                batch = []
+                for row in csv.DictReader(f):
+                    if not row.get("Serial Number"):
+                        continue
+                    batch.append(row)
+                    if len(batch) >= kInsertBatchSize:
+                        self.insert(batch, station, tested_at)
+                        count += len(batch)
+                        batch = []
+                self.insert(batch, station, tested_at)
+                count += len(batch)
+        finally:
+            if bulk:
+                self.create_indexes()
+        return count
+
+    def measurements(self, since=None, until=None, station=None):
+        """Yields (serial, {column: value}) for each matching test, oldest first."""
+        where, arguments = [], []
+        if since:
+            where.append("tested_at >= ?")
+            arguments.append(since)
+        if until:
+            where.append("tested_at < ?")
+            arguments.append(until)
+        if station:
+            where.append("station = ?")
+            arguments.append(station)
+        query = f"SELECT serial, {', '.join(kColumns.values())} FROM measurements"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY id"
+        names = list(kColumns.values())
+        for row in self.conn.execute(query, arguments):
+            yield row[0], {name: math.nan if value is None else value for name, value in zip(names, row[1:])}
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Import cell test CSVs into the shared SQLite cell database")
+    parser.add_argument("database", help="Path to the SQLite database (created if missing)")
+    parser.add_argument("csv_files", nargs="+", help="CSV files written by test_cells.py")
+    parser.add_argument("--station", default=None, help="Station name to record with the imported rows")
+    parser.add_argument("--tested-at", default=None,
+                        help=f"Test time to record, formatted like {time.strftime(kTimeFormat)} (default: each file's modification time)")
+    args = parser.parse_args()
+
+    db = CellDatabase(args.database)
+    try:
+        for file_path in args.csv_files:
+            start = time.monotonic()
+            try:
+                count = db.import_csv(file_path, args.station, args.tested_at)
+            except FileNotFoundError:
+                print(f"Error: File not found: {file_path}")
+                sys.exit(1)
+            print(f"Imported {count} rows from {file_path} in {time.monotonic() - start:.2f} s")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import json
+import math
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+kSourceListMax = 100 # Points in a 2400-series :SOUR:LIST:CURR
+kReadingTime_seconds = 0.02 # Approximate source-measure time per point at 1 NPLC, taken out of the trigger delay
+
+class ProfileError(ValueError):
+    pass
+
+@dataclass
+class ProfileStep:
+    name: str
+    current: float # Amps, positive charges the cell
+    duration: float # Seconds
+    result: Optional[str] = None # CSV column to fill with this step's resistance, e.g. "DCIR Charge (Ohm)"
+
+@dataclass
+class TestProfile:
+    """A sequence of constant-current steps run as one instrument-timed sweep.
+
+    The 2430 applies a single compliance to a whole sweep, so voltage_limit is per profile.
+    Each step is held for a whole number of sample intervals.
+    """
+    name: str
+    voltage_limit: float
+    sample_interval: float
+    steps: List[ProfileStep] = field(default_factory=list)
+
+@dataclass
+class CompiledProfile:
+    profile: TestProfile
+    currents: List[float] # One source-list point per sample
+    trigger_delay: float
+    step_ends: List[int] # Index of each step's last point
+
+def load_profile(file_path) -> TestProfile:
+    """Reads a profile like:
+
+        {"name": "dcir", "voltage_limit": 4.2, "sample_interval": 1.0,
+         "steps": [{"name": "rest", "current": 0, "duration": 1},
+                   {"name": "charge", "current": 3, "duration": 10, "result": "DCIR Charge (Ohm)"}]}
+    """
+    with open(file_path) as f:
+        data = json.load(f)
+    try:
+        steps = [ProfileStep(s["name"], float(s["current"]), float(s["duration"]), s.get("result")) for s in data["steps"]]
+        return TestProfile(data["name"], float(data["voltage_limit"]), float(data["sample_interval"]), steps)
+    except (KeyError, TypeError, ValueError) as e:
+        raise ProfileError(f"{file_path}: invalid profile: {e}") from e
+
+def compile_profile(profile: TestProfile) -> CompiledProfile:
+    """Expands the steps into source-list points, one per sample interval."""
+    if not profile.steps:
+        raise ProfileError(f"profile {profile.name} has no steps")
+    if profile.sample_interval <= kReadingTime_seconds:
+        raise ProfileError(f"sample_interval must be longer than the {kReadingTime_seconds} s reading time")
+    currents, step_ends = [], []
+    for step in profile.steps:
+        points = step.duration / profile.sample_interval
+        if points < 1 or not math.isclose(points, round(points), abs_tol=1e-6):
+            raise ProfileError(f"step {step.name}: duration {step.duration} s is not a multiple of the "
+                               f"{profile.sample_interval} s sample interval")
+        currents.extend([step.current] * round(points))
+        step_ends.append(len(currents) - 1)
+    if len(currents) > kSourceListMax:
+        raise ProfileError(f"profile {profile.name} needs {len(currents)} points, the source list holds {kSourceListMax}; "
+                           "lengthen sample_interval")
+    return CompiledProfile(profile, currents, profile.sample_interval - kReadingTime_seconds, step_ends)
+
+def step_resistances(compiled: CompiledProfile, trace) -> Dict[str, float]:
+    """Resistance of each step that changes the current, from the voltages at the ends of it and the step before.
+
+    The sign follows run_tests(): positive for both charge and discharge steps.
+    """
+    profile = compiled.profile
+    resistances = {}
+    for k in range(1, len(profile.steps)):
+        before, step = profile.steps[k - 1], profile.steps[k]
+        if step.current == before.current:
+            continue
+        dv = trace.voltages[compiled.step_ends[k]] - trace.voltages[compiled.step_ends[k - 1]]
+        resistances[step.name] = dv / (step.current - before.current)
+    return resistances
@@ -0,0 +1,144 @@
+import bisect
+import contextlib
+import json
+import math
+import time
+from array import array
+
+# Latency histogram bins: log-spaced from 100 us to 1000 s, with an underflow and an overflow bin.
+kHistogramMin_seconds = 1e-4
+kHistogramDecades = 7
+kBinsPerDecade = 5
+kHistogramEdges = [kHistogramMin_seconds * 10 ** (k / kBinsPerDecade) for k in range(kHistogramDecades * kBinsPerDecade + 1)]
+
+class _Span:
+    __slots__ = ("timer", "key", "start")
+
+    def __init__(self, timer, key):
+        self.timer = timer
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer._record(self.key, time.perf_counter() - self.start)
+        return False
+
+class CycleTimer:
+    """Records where a station's time goes, per cell and as latency distributions.
+
+    span(kind, name) times one operation, e.g. ("scpi", ":MEAS:VOLT?") or ("dwell", "dcir hold").
+    phase(name) is a lap timer: it ends the running phase and starts the next, so the phases of
+    a cell add up to its cycle time. end_cell() closes a cell's record, and time spent until
+    the next cell starts (waiting for a scan) counts towards that next cell. One timer per
+    thread; combine them with write_report().
+    """
+
+    def __init__(self, station=None):
+        self.station = station
+        self.samples = {} # (kind, name) -> array of seconds
+        self.cells = []
+        self.running = None # (phase name, start)
+        self.cycle_start = time.perf_counter()
+        self._reset_cell()
+
+    def _reset_cell(self):
+        self.cell_phases = {}
+        self.cell_kinds = {}
+
+    def _record(self, key, elapsed):
+        samples = self.samples.get(key)
+        if samples is None:
+            samples = self.samples[key] = array('d')
+        samples.append(elapsed)
+        self.cell_kinds[key[0]] = self.cell_kinds.get(key[0], 0.0) + elapsed
+
+    def span(self, kind, name):
+        return _Span(self, (kind, name))
+
+    def command(self, command):
+        """Times one instrument command, filed under its SCPI header."""
+        return _Span(self, ("scpi", command.split(" ", 1)[0].upper()))
+
+    def phase(self, name):
+        """Ends the running phase, if any, and starts `name` (None to start nothing)."""
+        now = time.perf_counter()
+        if self.running:
+            running, start = self.running
+            elapsed = now - start
+            self._record(("phase", running), elapsed)
+            self.cell_phases[running] = self.cell_phases.get(running, 0.0) + elapsed
+        self.running = (name, now) if name else None
+
+    def end_cell(self, serial_number):
+        """Closes the running phase and files the cell's breakdown."""
+        self.phase(None)
+        now = time.perf_counter()
+        self.cells.append({
+            "serial": serial_number,
+            "station": self.station,
+            "finished": time.time(),
+            "cycle_seconds": now - self.cycle_start,
+            "phases": self.cell_phases,
+            # Time inside the phases spent on the bus and in deliberate waits.
+            "scpi_seconds": self.cell_kinds.get("scpi", 0.0),
+            "dwell_seconds": self.cell_kinds.get("dwell", 0.0),
+        })
+        self.cycle_start = now
+        self._reset_cell()
+
+class NullTimer:
+    """Stands in for CycleTimer when timing is off; every call is a no-op."""
+    _span = contextlib.nullcontext()
+
+    def span(self, kind, name):
+        return self._span
+
+    def command(self, command):
+        return self._span
+
+    def phase(self, name):
+        pass
+
+    def end_cell(self, serial_number):
+        pass
+
+kNullTimer = NullTimer()
+
+def summarize(samples):
+    """Count, total, mean, percentiles and a log-binned histogram of a sequence of seconds."""
+    ordered = sorted(samples)
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)]
+    counts = [0] * (len(kHistogramEdges) + 1)
+    for value in ordered:
+        counts[bisect.bisect_right(kHistogramEdges, value)] += 1
+    return {
+        "count": len(ordered),
+        "total_seconds": sum(ordered),
+        "mean_seconds": sum(ordered) / len(ordered),
+        "p50_seconds": percentile(50),
+        "p95_seconds": percentile(95),
+        "max_seconds": ordered[-1],
+        # counts[0] is below edges[0], counts[k] is [edges[k-1], edges[k]), counts[-1] is above edges[-1].
+        "histogram": {"edges_seconds": kHistogramEdges, "counts": counts},
+    }
+
+def write_report(file_path, timers):
+    """Writes every cell's breakdown and the latency distributions of all timers as JSON.
+
+    Returns the cell records, in the order they were finished.
+    """
+    cells = sorted((cell for timer in timers for cell in timer.cells), key=lambda cell: cell["finished"])
+    merged = {}
+    for timer in timers:
+        for key, samples in timer.samples.items():
+            merged.setdefault(key, array('d')).extend(samples)
+    latency = {}
+    for (kind, name), samples in sorted(merged.items()):
+        latency.setdefault(kind, {})[name] = summarize(samples)
+    with open(file_path, 'w') as f:
+        json.dump({"cells": cells, "latency": latency}, f, indent=2)
+    return cells
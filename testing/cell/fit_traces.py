@@ -0,0 +1,263 @@
+import argparse
+import csv
+import itertools
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+kTauGrid_seconds = np.geomspace(0.05, 200.0, 37) # Candidate RC time constants, about 26% apart
+kRefinements = 4 # Rounds of local refinement around the best grid fit, each twice as fine
+kStepThreshold_amps = 0.1 # A current change larger than this is a new step; smaller ones are noise
+kFitChunk = 64 # Traces per vectorized solve; bounds the (traces, samples, time constants) arrays to tens of MB
+kRidge = 1e-9 # Relative regularization for nearly collinear responses
+kMaxPairs = 2 # group_cells.py reads the parameters of up to this many RC pairs
+
+def fit_columns(pairs):
+    columns = ["Fit R0 (Ohm)"]
+    for k in range(1, pairs + 1):
+        columns += [f"Fit R{k} (Ohm)", f"Fit Tau{k} (s)"]
+    return columns + ["Fit RMS (V)"]
+
+def prepare_trace(times, voltages, currents, ocv):
+    """Turns a trace into (t, y, levels, settle_time) for fitting, or None if it cannot be fitted.
+
+    y is the voltage above the cell's OCV. levels is the current as a piecewise-constant
+    program: the measured currents are split into steps wherever they change by more than
+    kStepThreshold_amps, and every sample gets its step's median. settle_time is the shortest
+    time from a step change to the first sample after it, which bounds the fastest time
+    constant the trace can resolve.
+    """
+    if math.isnan(ocv):
+        return None
+    times = np.asarray(times, dtype=np.float64)
+    currents = np.asarray(currents, dtype=np.float64)
+    bounds = [0, *(np.flatnonzero(np.abs(np.diff(currents)) > kStepThreshold_amps) + 1), len(currents)]
+    levels = np.concatenate([np.full(b - a, np.median(currents[a:b])) for a, b in zip(bounds[:-1], bounds[1:])])
+    if not (np.abs(levels) > kStepThreshold_amps).any():
+        return None
+    # A step is taken to start right after the last reading of the one before.
+    starts = np.array([0.0] + [times[b - 1] for b in bounds[1:-1]])
+    settle_time = float(np.min(times[bounds[:-1]] - starts))
+    return times, np.asarray(voltages, dtype=np.float64) - ocv, levels, settle_time
+
+def _filtered(t, levels, taus):
+    """The current through the resistor of an RC pair with each time constant, from rest at t = 0.
+
+    t and levels are (traces, samples); taus is (traces, ...), or (1, ...) to use the same time
+    constants for every trace. Exact for piecewise-constant current. Returns (traces, samples, ...).
+    """
+    shape = np.broadcast_shapes(taus.shape, t.shape[:1] + (1,) * (taus.ndim - 1))
+    expand = (slice(None),) + (None,) * (len(shape) - 1)
+    filtered = np.empty(t.shape[:1] + t.shape[1:] + shape[1:])
+    x = np.zeros(shape)
+    previous = np.zeros(len(t))
+    for m in range(t.shape[1]):
+        level = levels[:, m][expand]
+        x = level + (x - level) * np.exp(-(t[:, m] - previous)[expand] / taus)
+        filtered[:, m] = x
+        previous = t[:, m]
+    return filtered
+
+def _feasible(r0, r, taus, settle_time, duration):
+    """Positive resistances, and time constants the samples can resolve."""
+    return ((r > 0).all(axis=-1) & (r0 > 0)
+            & (taus.min(axis=-1) >= settle_time[:, None]) & (taus.max(axis=-1) <= duration[:, None]))
+
+def _best(sse, feasible):
+    """Index of the feasible candidate with the smallest residual in every row, and whether there is one."""
+    score = np.where(feasible, sse, np.inf)
+    best = np.argmin(score, axis=1)
+    return best, np.isfinite(score[np.arange(len(score)), best])
+
+def _solve(normal, rhs, yy):
+    """Solves batched normal equations. Returns the residual sum of squares and the coefficients of each candidate."""
+    size = normal.shape[-1]
+    normal = normal + kRidge * np.trace(normal, axis1=-2, axis2=-1)[..., None, None] * np.eye(size)
+    coef = np.linalg.solve(normal, rhs[..., None])[..., 0]
+    # At the least-squares solution the residual is y.y - coef.rhs.
+    return yy[:, None] - np.einsum('sgi,sgi->sg', coef, rhs), coef
+
+def fit_batch(t, y, levels, mask, settle_time, pairs):
+    """Fits y = R0 i + sum_k R_k x_k to every row of a padded batch of traces.
+
+    t, y and levels are (traces, samples) arrays, mask being 1 for real samples and 0 for
+    padding. x_k is the current filtered by an RC pair with time constant tau_k. For fixed time
+    constants the model is linear in the resistances, so every combination of time constants
+    from kTauGrid_seconds is solved at once through its normal equations, which are picked out
+    of one Gram matrix over the whole grid. The best combination is then refined on
+    successively finer local grids, kRefinements times. Only fits with positive resistances
+    and time constants between settle_time and the trace's duration count; traces without one
+    get NaN.
+
+    Returns r0 (traces,), r (traces, pairs), tau (traces, pairs) and the RMS residual (traces,).
+    """
+    rows = np.arange(len(t))
+    weighted_y = mask * y
+    yy = np.einsum('sm,sm->s', weighted_y, y)
+    duration = np.where(mask > 0, t, -np.inf).max(axis=1)
+
+    combinations = np.array(list(itertools.combinations(range(len(kTauGrid_seconds)), pairs)))
+    basis = np.concatenate([levels[..., None], _filtered(t, levels, kTauGrid_seconds[None, :])], axis=-1)
+    gram = np.swapaxes(basis * mask[..., None], -1, -2) @ basis
+    projections = (np.swapaxes(basis, -1, -2) @ weighted_y[..., None])[..., 0]
+    columns = np.concatenate([np.zeros((len(combinations), 1), dtype=np.intp), combinations + 1], axis=1)
+    sse, coef = _solve(gram[:, columns[:, :, None], columns[:, None, :]], projections[:, columns], yy)
+    taus = np.broadcast_to(kTauGrid_seconds[combinations], (len(t),) + combinations.shape)
+    best, found = _best(sse, _feasible(coef[..., 0], coef[..., 1:], taus, settle_time, duration))
+    best_taus, best_sse, best_coef = taus[rows, best], sse[rows, best], coef[rows, best]
+
+    # Local refinement in log time constant, halving the spacing every round.
+    spacing = math.log(kTauGrid_seconds[1] / kTauGrid_seconds[0]) / 2
+    offsets = np.array(list(itertools.product((-1.0, -0.5, 0.0, 0.5, 1.0), repeat=pairs)))
+    for _ in range(kRefinements):
+        taus = best_taus[:, None, :] * np.exp(spacing * offsets) # (traces, candidates, pairs)
+        responses = np.moveaxis(_filtered(t, levels, taus), 1, 2) # (traces, candidates, samples, pairs)
+        design = np.concatenate([np.broadcast_to(levels[:, None, :, None], responses.shape[:3] + (1,)), responses], axis=-1)
+        weighted = np.swapaxes(design * mask[:, None, :, None], -1, -2)
+        sse, coef = _solve(weighted @ design, (weighted @ y[:, None, :, None])[..., 0], yy)
+        # Traces with no feasible grid fit stay unfitted; the center candidate keeps the others feasible.
+        best, refined = _best(sse, _feasible(coef[..., 0], coef[..., 1:], taus, settle_time, duration))
+        refined &= found
+        best_taus = np.where(refined[:, None], taus[rows, best], best_taus)
+        best_sse = np.where(refined, sse[rows, best], best_sse)
+        best_coef = np.where(refined[:, None], coef[rows, best], best_coef)
+        spacing /= 2
+
+    nan = np.where(found, 1.0, np.nan)
+    order = np.argsort(best_taus, axis=1) # Fastest pair first
+    rms = np.sqrt(np.maximum(best_sse, 0.0) / mask.sum(axis=1))
+    return (best_coef[:, 0] * nan, np.take_along_axis(best_coef[:, 1:], order, axis=1) * nan[:, None],
+            np.take_along_axis(best_taus, order, axis=1) * nan[:, None], rms * nan)
+
+def _fit_chunk(traces, pairs):
+    length = max(len(trace[0]) for trace in traces)
+    # Padding repeats the last sample, so the filters see no time pass; the mask drops it from the fit.
+    t, y, levels = (np.array([np.pad(trace[k], (0, length - len(trace[k])), mode='edge') for trace in traces]) for k in range(3))
+    mask = np.array([np.arange(length) < len(trace[0]) for trace in traces], dtype=np.float64)
+    return fit_batch(t, y, levels, mask, np.array([trace[3] for trace in traces]), pairs)
+
+def fit_traces(traces, pairs, workers=1):
+    """Fits a list of prepare_trace() traces in chunks of similar length, optionally in a process pool.
+
+    Returns r0, r, tau and rms arrays in the order of traces.
+    """
+    order = sorted(range(len(traces)), key=lambda k: len(traces[k][0])) # Little padding within a chunk
+    chunks = [[traces[k] for k in order[i:i + kFitChunk]] for i in range(0, len(order), kFitChunk)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            fitted = list(executor.map(_fit_chunk, chunks, itertools.repeat(pairs)))
+    else:
+        fitted = [_fit_chunk(chunk, pairs) for chunk in chunks]
+    r0, r, tau, rms = (np.concatenate(parts) for parts in zip(*fitted))
+    unsorted = np.empty(len(order), dtype=np.intp)
+    unsorted[order] = np.arange(len(order))
+    return r0[unsorted], r[unsorted], tau[unsorted], rms[unsorted]
+
+def first_archive_trace(archive, serial_number):
+    steps = archive.steps(serial_number)
+    if not steps:
+        return None
+    trace = archive.trace(serial_number, steps[0])
+    return trace["time"], trace["voltage"], trace["current"]
+
+def first_csv_trace(directory, serial_number):
+    """Reads the first step of a --trace-dir file written by test_cells.py."""
+    samples = []
+    step = None
+    try:
+        with open(os.path.join(directory, f"{serial_number}.csv"), newline='') as f:
+            for row in csv.DictReader(f):
+                if samples and row["Step"] != step:
+                    break
+                step = row["Step"]
+                samples.append((float(row["Time (s)"]), float(row["Voltage (V)"]), float(row["Current (A)"])))
+    except FileNotFoundError:
+        return None
+    return tuple(zip(*samples)) if samples else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit an R0 + n x RC equivalent circuit to every cell's recorded trace")
+    parser.add_argument("--input", nargs="+", required=True, help="Results CSVs written by test_cells.py")
+    parser.add_argument("--archive", default=None, help="Waveform archive written by test_cells.py --waveform-archive")
+    parser.add_argument("--trace-dir", default=None, help="Trace directory written by test_cells.py --trace-dir")
+    parser.add_argument("--output", required=True,
+                        help="CSV to write: the input rows with the fitted parameters added, ready for group_cells.py")
+    parser.add_argument("--pairs", type=int, choices=range(1, kMaxPairs + 1), default=kMaxPairs, help="Number of RC pairs in the model")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes to fit in (default: 1, no pool)")
+    args = parser.parse_args()
+    if (args.archive is None) == (args.trace_dir is None):
+        parser.error("exactly one of --archive and --trace-dir is required")
+
+    fieldnames, rows = [], []
+    for file_path in args.input:
+        try:
+            with open(file_path, newline='', encoding='utf-8-sig') as f:
+                reader = csv.DictReader(f)
+                fieldnames += [name for name in reader.fieldnames or [] if name not in fieldnames and not name.startswith("Fit ")]
+                rows += [row for row in reader if row.get("Serial Number")]
+        except FileNotFoundError:
+            print(f"Error: File not found: {file_path}")
+            sys.exit(1)
+    # With retests, the latest OCV goes with the latest trace.
+    ocvs = {}
+    for row in rows:
+        try:
+            ocvs[row["Serial Number"]] = float(row["OCV (V)"])
+        except (KeyError, ValueError):
+            ocvs[row["Serial Number"]] = math.nan
+
+    if args.archive:
+        from waveform_archive import WaveformArchive
+        try:
+            archive = WaveformArchive(args.archive)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        first_trace = lambda serial: first_archive_trace(archive, serial)
+    else:
+        first_trace = lambda serial: first_csv_trace(args.trace_dir, serial)
+
+    # Only a cell's first trace starts from rest: run_tests() starts each DCIR hold right after
+    # the one before, and traces do not record the time in between.
+    start = time.monotonic()
+    serials, traces = [], []
+    for serial, ocv in ocvs.items():
+        samples = first_trace(serial)
+        prepared = prepare_trace(*samples, ocv) if samples else None
+        if prepared:
+            serials.append(serial)
+            traces.append(prepared)
+    read_seconds = time.monotonic() - start
+    if not traces:
+        print("Error: no traces with a current step found for the input cells")
+        sys.exit(1)
+
+    start = time.monotonic()
+    r0, r, tau, rms = fit_traces(traces, args.pairs, args.workers)
+    fit_seconds = time.monotonic() - start
+
+    columns = fit_columns(args.pairs)
+    fits = {}
+    for k, serial in enumerate(serials):
+        if not math.isnan(r0[k]):
+            values = [r0[k]] + [x for pair in zip(r[k], tau[k]) for x in pair]
+            fits[serial] = dict(zip(columns, [f"{x:.6g}" for x in values] + [f"{rms[k]:.3g}"]))
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames + columns, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({**row, **fits.get(row["Serial Number"], {})})
+
+    print(f"Fitted {len(fits)} of {len(traces)} traces in {fit_seconds:.2f} s "
+          f"({len(traces) / fit_seconds:.0f} traces/s; reading them took {read_seconds:.2f} s)")
+    missing = len(ocvs) - len(fits)
+    if missing:
+        print(f"Warning: {missing} cells have no trace that could be fitted; their fit columns are left empty")
+    print(f"Wrote {len(rows)} rows to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import csv
+import os
+import time
+
+kSyncPolicies = ("row", "batch", "none")
+kBatchRows = 20 # With the batch policy, sync after this many rows...
+kBatchInterval_seconds = 30.0 # ...or once a row is written this long after the last sync
+kRecoveryChunk_bytes = 65536
+kPartialSuffix = ".partial"
+
+class ResultJournal:
+    """Append-only results CSV, kept open for the whole session.
+
+    Opening it checks that an existing file has the expected header before touching it, then
+    makes sure the next row starts on a line of its own. A last row without its newline is kept
+    if it has every column, as a file saved by a spreadsheet can end that way; anything shorter
+    is a partial row from a crash or power cut in the middle of a write, and is moved to
+    path + ".partial". It also indexes the serial numbers already in the file, so retests can be
+    flagged as soon as a cell is scanned.
+
+    sync is when rows are forced to disk: "row" syncs after every row, "batch" after
+    kBatchRows rows or kBatchInterval_seconds, and "none" leaves it to the operating system.
+    Rows are always flushed, so other programs can read them straight away.
+    """
+    def __init__(self, path, fieldnames, sync="row"):
+        if sync not in kSyncPolicies:
+            raise ValueError(f"unknown sync policy {sync!r}, expected one of {', '.join(kSyncPolicies)}")
+        self.path = path
+        self.fieldnames = list(fieldnames)
+        self.sync = sync
+        self.partial_path = path + kPartialSuffix
+        self.recovered_bytes = 0
+        self.serials = set()
+        self.rows = 0
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new:
+            self._check_header()
+            self.recovered_bytes = self._recover()
+            self._index()
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames)
+        if new:
+            self.writer.writeheader()
+            self._sync()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def _check_header(self):
+        with open(self.path, newline='', encoding='utf-8-sig') as f:
+            header = next(csv.reader(f), None)
+        if header != self.fieldnames:
+            raise ValueError(f"{self.path} was written with different columns (e.g. with or without --adaptive-dcir); "
+                             "use a new output file")
+
+    def _recover(self):
+        """Ends the file on a complete line. Returns the number of bytes moved to partial_path."""
+        with open(self.path, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - kRecoveryChunk_bytes)
+                f.seek(start)
+                chunk = f.read(end - start)
+                newline = chunk.rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end == size:
+                return 0
+            f.seek(end)
+            tail = f.read()
+            try:
+                complete = len(next(csv.reader([tail.decode('utf-8-sig')]))) == len(self.fieldnames)
+            except (UnicodeDecodeError, csv.Error):
+                complete = False
+            if complete:
+                f.write(b"\n")
+            else:
+                with open(self.partial_path, 'ab') as partial:
+                    partial.write(tail + b"\n")
+                    partial.flush()
+                    os.fsync(partial.fileno())
+                f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+            return 0 if complete else len(tail)
+
+    def _index(self):
+        with open(self.path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            next(reader) # Header, checked by _check_header()
+            for row in reader:
+                if row:
+                    self.serials.add(row[0])
+                    self.rows += 1
+
+    def __contains__(self, serial_number):
+        return serial_number in self.serials
+
+    def write(self, results):
+        self.writer.writerow(results)
+        self.serials.add(results["Serial Number"])
+        self.rows += 1
+        self.unsynced += 1
+        if self.sync == "row" or (self.sync == "batch" and (self.unsynced >= kBatchRows or
+                                                             time.monotonic() - self.last_sync >= kBatchInterval_seconds)):
+            self._sync()
+        else:
+            self.file.flush()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if not self.file.closed:
+            self._sync()
+            self.file.close()
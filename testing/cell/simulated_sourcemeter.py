@@ -0,0 +1,301 @@
+import math
+import random
+import struct
+import time
+
+# Serial link and instrument timing.
+kBaudRate = 57600
+kBitsPerByte = 10 # 8N1: start bit, 8 data bits, stop bit
+kCommandLatency_seconds = 0.002 # Parsing and settling per command
+kReadingOverhead_seconds = 0.003 # Per source-measure cycle, on top of the integration time
+kLineFrequency_hertz = 60.0
+kVoltageNoise_volts = 0.00005 # Reading noise, one standard deviation
+
+# Simulated operator: after the success beep, the cell is removed and a new one seated.
+kOperatorRemove_seconds = 1.5
+kOperatorInsert_seconds = 3.0
+
+kOverflow = 9.91e37 # What the 2400 series reports for a value it did not measure
+kComplianceStatus = 8 # Status word bit for "in compliance"
+
+class SimulatedCell:
+    """OCV plus R0 and two RC pairs, with randomized parameters around a 21700 cell."""
+    def __init__(self, rng):
+        self.ocv = rng.gauss(3.60, 0.002)
+        self.r0 = rng.lognormvariate(math.log(0.025), 0.05)
+        # (resistance, time constant) pairs; the slow pair is what the 10 s DCIR holds see settle.
+        self.pairs = [(rng.lognormvariate(math.log(0.015), 0.08), 0.4), (rng.lognormvariate(math.log(0.030), 0.08), 4.0)]
+        self.rc_voltages = [0.0 for _ in self.pairs]
+
+    def emf(self):
+        return self.ocv + sum(self.rc_voltages)
+
+    def advance(self, current, dt):
+        """Holds a constant current for dt seconds (exact for piecewise-constant current)."""
+        for k, (r, tau) in enumerate(self.pairs):
+            target = current * r
+            self.rc_voltages[k] = target + (self.rc_voltages[k] - target) * math.exp(-dt / tau)
+
+class SimulatedSourcemeter:
+    """Stands in for the pyvisa resource of a Keithley 2430 wired to a cell in a chuck.
+
+    It implements the SCPI subset test_cells.py uses: DC, pulse and list current sourcing with
+    voltage compliance, :MEAS?/:READ?, the trace buffer and trigger model, ASCII and SREAL data
+    formats and reading element selection. Every transfer sleeps for its serial byte time plus
+    a command latency, and sourced steps take real time, so cycle-time changes measured against
+    it carry over to the hardware. Positive current charges the cell. When charging would take
+    the terminals past the voltage limit, the source backs its current off to hold the limit.
+    Sinking is not limited, as on the instrument with the cell holding the terminals above it.
+    DC readings with the output off are taken at zero current.
+
+    The chuck starts with a cell seated. Each success beep cues a simulated operator, who
+    removes the cell after kOperatorRemove_seconds and seats a new one, with fresh parameters,
+    at kOperatorInsert_seconds.
+    """
+    def __init__(self, name="sim", seed=None, baud_rate=kBaudRate, command_latency=kCommandLatency_seconds):
+        self.rng = random.Random(name if seed is None else seed)
+        self.baud_rate = baud_rate
+        self.command_latency = command_latency
+        self.timeout = 2000 # Milliseconds, like pyvisa
+        self.cell = SimulatedCell(self.rng)
+        self.remove_at = self.insert_at = None
+        self.pending = None # Response waiting for read_bytes()
+        self._reset()
+        self.updated = self.time_zero = time.monotonic()
+
+    def _reset(self):
+        self.settings = {}
+        self.output = False
+        self.shape = "DC"
+        self.function = "CURR"
+        self.level = 0.0
+        self.voltage_level = 0.0
+        self.voltage_limit = 21.0
+        self.current_limit = 0.000105
+        self.list_currents = []
+        self.list_mode = False
+        self.pulse_width = 0.0
+        self.trigger_count = 1
+        self.trigger_delay = 0.0
+        self.nplc = 1.0
+        self.elements = ["VOLT", "CURR", "RES", "TIME", "STAT"]
+        self.binary = False
+        self.little_endian = False
+        self.buffer = []
+        self.buffer_points = 0
+        self.feeding = False
+        self.busy_until = 0.0
+
+    # pyvisa resource interface
+
+    def write(self, command):
+        self._transfer(len(command) + 1)
+        self._execute(command.strip())
+
+    def query(self, command):
+        self.write(command)
+        return self.read()
+
+    def read(self):
+        response, self.pending = self.pending, None
+        if response is None:
+            raise TimeoutError("simulated sourcemeter: nothing to read")
+        if isinstance(response, bytes):
+            raise ValueError("simulated sourcemeter: binary response, use read_bytes()")
+        self._transfer(len(response) + 1)
+        return response
+
+    def read_bytes(self, count):
+        response, self.pending = self.pending, None
+        if response is None:
+            raise TimeoutError("simulated sourcemeter: nothing to read")
+        if isinstance(response, str):
+            response = (response + "\n").encode()
+        if len(response) != count:
+            raise ValueError(f"simulated sourcemeter: {len(response)} bytes available, {count} requested")
+        self._transfer(count)
+        return response
+
+    def close(self):
+        pass
+
+    # Timing and physics
+
+    def _transfer(self, byte_count):
+        time.sleep(byte_count * kBitsPerByte / self.baud_rate + self.command_latency)
+
+    def _reading_time(self):
+        return self.nplc / kLineFrequency_hertz + kReadingOverhead_seconds
+
+    def _update(self):
+        """Advances the cell and the simulated operator to the present."""
+        now = time.monotonic()
+        if self.remove_at is not None and now >= self.remove_at:
+            self._advance_to(self.remove_at)
+            self.cell, self.remove_at = None, None
+        if self.insert_at is not None and now >= self.insert_at:
+            self.cell, self.insert_at = SimulatedCell(self.rng), None
+        self._advance_to(now)
+
+    def _advance_to(self, when):
+        if when > self.updated:
+            if self.cell and self.output:
+                self.cell.advance(self._current(self.level), when - self.updated)
+            self.updated = when
+
+    def _current(self, level):
+        """Current actually flowing for a programmed current level, after compliance."""
+        if not self.cell:
+            return 0.0
+        if self.function == "VOLT":
+            current = (self.voltage_level - self.cell.emf()) / self.cell.r0
+            return max(-self.current_limit, min(self.current_limit, current))
+        emf = self.cell.emf()
+        if level > 0 and emf + level * self.cell.r0 > self.voltage_limit:
+            return max(0.0, (self.voltage_limit - emf) / self.cell.r0)
+        return level
+
+    def _reading(self, level, timestamp):
+        """One reading, every element, at the present cell state with `level` programmed."""
+        if not self.cell:
+            # Open chuck: nothing to source into, and the sense leads float near zero.
+            voltage, current = self.rng.gauss(0.0, 0.001), 0.0
+        else:
+            current = self._current(level)
+            voltage = self.cell.emf() + current * self.cell.r0 + self.rng.gauss(0.0, kVoltageNoise_volts)
+        status = kComplianceStatus if current != level else 0
+        return {"VOLT": voltage, "CURR": current, "RES": kOverflow, "TIME": timestamp - self.time_zero, "STAT": status}
+
+    def _respond(self, readings):
+        """Formats readings with the elements selected now, as :FORM:ELEM applies on readout."""
+        values = [reading[e] for reading in readings for e in self.elements]
+        if self.binary:
+            order = "<" if self.little_endian else ">"
+            self.pending = b"#0" + struct.pack(f"{order}{len(values)}f", *values) + b"\n"
+        else:
+            self.pending = ",".join(f"{v:+.6E}" for v in values)
+
+    def _hold(self, level, duration):
+        """Sources `level` for `duration` seconds of simulated time, without sleeping."""
+        if self.cell:
+            self.cell.advance(self._current(level), duration)
+        self.updated += duration
+
+    # SCPI
+
+    def _execute(self, command):
+        header, _, argument = command.partition(" ")
+        header = header.upper()
+        if not header.startswith(":") and not header.startswith("*"):
+            header = ":" + header
+        self._update()
+        if header.endswith("?"):
+            self._query(header, argument)
+            return
+
+        self.settings[header] = argument
+        if header == "*RST":
+            self._reset()
+        elif header == ":OUTP":
+            self.output = argument.upper() in ("ON", "1")
+        elif header == ":SOUR:FUNC:SHAP":
+            self.shape = argument.upper()[:4]
+        elif header in (":SOUR:FUNC", ":SOUR:FUNC:MODE"):
+            self.function = argument.upper()[:4]
+        elif header in (":SOUR:CURR", ":SOUR:CURR:LEV"):
+            self.level = float(argument)
+        elif header in (":SOUR:VOLT", ":SOUR:VOLT:LEV"):
+            self.voltage_level = float(argument)
+        elif header == ":SOUR:CURR:MODE":
+            self.list_mode = argument.upper().startswith("LIST")
+        elif header == ":SOUR:LIST:CURR":
+            self.list_currents = [float(x) for x in argument.split(",")]
+        elif header == ":SOUR:PULS:WIDT":
+            self.pulse_width = float(argument)
+        elif header == ":SENS:VOLT:PROT":
+            self.voltage_limit = float(argument)
+        elif header == ":SENS:CURR:PROT":
+            self.current_limit = float(argument)
+        elif header == ":SENS:VOLT:NPLC":
+            self.nplc = float(argument)
+        elif header == ":TRIG:COUN":
+            self.trigger_count = int(argument)
+        elif header == ":TRIG:DEL":
+            self.trigger_delay = float(argument)
+        elif header == ":FORM:ELEM":
+            requested = [e.strip().upper()[:4] for e in argument.split(",")]
+            self.elements = [e for e in ("VOLT", "CURR", "RES", "TIME", "STAT") if e in requested]
+        elif header == ":FORM:DATA":
+            self.binary = argument.upper().startswith("SRE")
+        elif header == ":FORM:BORD":
+            self.little_endian = argument.upper().startswith("SWAP")
+        elif header == ":TRAC:CLE":
+            self.buffer = []
+        elif header == ":TRAC:POIN":
+            self.buffer_points = int(argument)
+        elif header == ":TRAC:FEED:CONT":
+            self.feeding = argument.upper().startswith("NEXT")
+        elif header == ":SYST:TIME:RES":
+            self.time_zero = time.monotonic()
+        elif header == ":INIT":
+            self._sweep(store=True)
+        elif header == ":SYST:BEEP:IMM":
+            # The success beep is the operator's cue to swap cells.
+            now = time.monotonic()
+            self.remove_at, self.insert_at = now + kOperatorRemove_seconds, now + kOperatorInsert_seconds
+
+    def _query(self, header, argument):
+        if header == "*IDN?":
+            self.pending = "KEITHLEY INSTRUMENTS INC.,MODEL 2430,SIMULATED,C00"
+        elif header == ":SYST:ERR?":
+            self.pending = '0,"No error"' # Every supported command is accepted
+        elif header == "*OPC?":
+            # Answers once the running sweep has finished.
+            remaining = self.busy_until - time.monotonic()
+            if remaining > self.timeout / 1000:
+                time.sleep(self.timeout / 1000)
+                raise TimeoutError("simulated sourcemeter: *OPC? timed out")
+            if remaining > 0:
+                time.sleep(remaining)
+            self._update()
+            self.pending = "1"
+        elif header in (":MEAS:VOLT?", ":MEAS:CURR?", ":MEAS?"):
+            # :MEAS? implies :CONF, which resets the trigger model.
+            self.trigger_count, self.trigger_delay = 1, 0.0
+            self._respond(self._sweep(store=False))
+        elif header == ":READ?":
+            self._respond(self._sweep(store=False))
+        elif header == ":TRAC:DATA?":
+            self._respond(self.buffer)
+        else:
+            raise ValueError(f"simulated sourcemeter: unsupported query {header}")
+
+    def _sweep(self, store):
+        """Runs the trigger model: trigger_count source-measure cycles, each after the trigger delay.
+
+        The cell state is computed up front; the instrument is busy (and :READ? blocks) until the
+        sweep would have finished in real time.
+        """
+        start = max(time.monotonic(), self.busy_until)
+        self._advance_to(start)
+        readings = []
+        if self.shape == "PULS":
+            # One pulse per trigger; the reading is taken at the end of the pulse, then the output drops.
+            for _ in range(self.trigger_count):
+                self._hold(0.0, self.trigger_delay)
+                self._hold(self.level, self.pulse_width)
+                readings.append(self._reading(self.level, self.updated))
+        else:
+            for k in range(self.trigger_count):
+                level = self.list_currents[k % len(self.list_currents)] if self.list_mode and self.list_currents else self.level
+                level = level if self.output else 0.0
+                self._hold(level, self.trigger_delay + self._reading_time())
+                readings.append(self._reading(level, self.updated))
+            if self.list_mode and self.list_currents:
+                self.level = self.list_currents[(self.trigger_count - 1) % len(self.list_currents)]
+        self.busy_until = self.updated
+        if store and self.feeding:
+            self.buffer.extend(readings[:max(0, self.buffer_points - len(self.buffer))])
+        if not store:
+            time.sleep(max(0.0, self.busy_until - time.monotonic()))
+        return readings
@@ -1,10 +1,24 @@
 import argparse
 import csv
+import math
+import os
 import time
 import sys
 import string
+import re
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import List
+
 import pyvisa
 
+import cell_profiles
+import simulated_sourcemeter
+import cycle_timer
+import result_journal
+from cell_database import CellDatabase
+
 required_packages = {
     'pyvisa': 'pyvisa',
     'serial': 'pyserial'
@@ -29,11 +43,74 @@ kR0PulseDuration_seconds = 0.0025
 kDcirCurrent_amps = 3.0
 kDcirDuration_seconds = 10.0
 kVoltageSenseDwell_seconds = 0.1
+kCellPresentMin_volts = 2.0 # A seated cell reads between this and the charge compliance limit
+kCellPollInterval_seconds = 0.5
+kTracePoints = 100 # Voltage samples per DCIR hold in --trace-dir mode (the 2430 buffer holds 2500)
+kSettleTolerance_volts_per_second = 0.001 # Adaptive DCIR holds end once the voltage drifts slower than this
+kSettleWindow_seconds = 1.0 # Trailing window the drift is fitted over; also the shortest adaptive hold
+kSettlePollInterval_seconds = 0.1
+kErrorQueueDepth = 10 # Messages the 2430's SCPI error queue holds
+
+@dataclass
+class Trace:
+    """Readings captured in the instrument's buffer during one source step."""
+    # Sequences of floats: lists, or float views over a binary transfer.
+    times: List[float] = field(default_factory=list) # Seconds since the step started
+    voltages: List[float] = field(default_factory=list)
+    currents: List[float] = field(default_factory=list)
+
+@dataclass
+class SettleCriteria:
+    """When an adaptive DCIR hold may end."""
+    tolerance: float # Volts per second
+    max_duration: float # Seconds
+    window: float = kSettleWindow_seconds
+
+def settling_slope(times, voltages, since):
+    """Least-squares slope in V/s of the readings taken at or after `since` seconds."""
+    points = [(t, v) for t, v in zip(times, voltages) if t >= since]
+    if len(points) < 2:
+        return math.inf
+    mean_t = sum(t for t, _ in points) / len(points)
+    mean_v = sum(v for _, v in points) / len(points)
+    spread = sum((t - mean_t) ** 2 for t, _ in points)
+    if spread == 0:
+        return math.inf
+    return sum((t - mean_t) * (v - mean_v) for t, v in points) / spread
+
+kNonPrintable = re.compile(f"[^{re.escape(string.printable)}]")
+
+# Settings that :MEASure? changes as part of its implied :CONFigure.
+kConfigureSideEffects = (":SENS:FUNC", ":SENS:VOLT:RANG", ":SENS:CURR:RANG", ":ARM:COUN", ":TRIG:COUN", ":TRIG:DEL")
 
 class Keithley2430:
-    def __init__(self, resource_name, mock=False, terminals='front'):
+    """Keithley 2430 over VISA.
+
+    Configuration commands go through _set(), which keeps a shadow copy of every setting it
+    has sent and skips a write when the instrument already holds that value. The shadow is
+    cleared on *RST, whenever a bus operation fails and whenever check_errors() finds a command
+    the instrument rejected, since the instrument state is then unknown. writes_sent and writes_saved count the configuration writes made and skipped.
+
+    Each reading only requests the elements it uses. With binary set, readings are transferred
+    as 4-byte floats (:FORM:DATA SREAL) and returned as views over the received bytes. With
+    voltage_only_traces set, buffered traces transfer only voltages and use nominal times and
+    the programmed currents. With simulate set, the SCPI goes to a SimulatedSourcemeter instead
+    of the bus. Every bus operation is timed on timer, a cycle_timer.CycleTimer (by default the
+    no-op kNullTimer).
+    """
+    def __init__(self, resource_name, mock=False, terminals='front', binary=False, voltage_only_traces=False, simulate=False,
+                 timer=None):
         self.mock = mock
-        if not self.mock:
+        self.timer = timer or cycle_timer.kNullTimer
+        self.binary = binary
+        self.voltage_only_traces = voltage_only_traces
+        self.shadow = {}
+        self.writes_sent = 0
+        self.writes_saved = 0
+        if simulate:
+            print(f"Simulating {resource_name}")
+            self.inst = simulated_sourcemeter.SimulatedSourcemeter(resource_name)
+        elif not self.mock:
             rm = pyvisa.ResourceManager()
             self.inst = rm.open_resource(
                 resource_name,
@@ -44,105 +121,318 @@ class Keithley2430:
                 write_termination="\n",
                 read_termination="\n",
                 )
-            self.inst.write("*RST")
-            self.inst.write(":SYST:RSEN ON") # 4-wire mode
-            
-            # Select terminals
-            if terminals.lower() == 'rear':
-                self.inst.write(":ROUT:TERM REAR")
-            else:
-                self.inst.write(":ROUT:TERM FRONT")
         else:
             print(f"Mocking connection to {resource_name}")
+        self.reset()
+        self._set(":SYST:RSEN", "ON") # 4-wire mode
+
+        # Select terminals
+        self._set(":ROUT:TERM", "REAR" if terminals.lower() == 'rear' else "FRONT")
+
+        if self.binary:
+            self._set(":FORM:DATA", "SREAL")
+            # Match the host's byte order so the floats can be used in place.
+            self._set(":FORM:BORD", "SWAP" if sys.byteorder == "little" else "NORM")
+
+    def _send(self, command):
+        """Writes a command, forgetting the shadowed state if the write fails."""
+        if self.mock:
+            return
+        try:
+            with self.timer.command(command):
+                self.inst.write(command)
+        except Exception:
+            self.shadow.clear()
+            raise
+
+    def _query(self, command, span=None):
+        """Sends a query and returns the response, timed as a bus command unless another span is given."""
+        if self.mock:
+            return ""
+        try:
+            with span or self.timer.command(command):
+                return self.inst.query(command)
+        except Exception:
+            self.shadow.clear()
+            raise
+
+    def _set(self, header, value):
+        """Sends `header value` unless the shadow says the instrument already has it."""
+        value = str(value)
+        if self.shadow.get(header) == value:
+            self.writes_saved += 1
+            return
+        self._send(f"{header} {value}")
+        self.shadow[header] = value
+        self.writes_sent += 1
+
+    def _read(self, command, elements, readings=1):
+        """Sends a query that returns readings and decodes them.
+
+        elements must be in the order the instrument returns them: VOLT, CURR, RES, TIME, STAT. Returns a flat sequence of floats, len(elements)
+        per reading: a list for ASCII, or a zero-copy float view of the received block in binary.
+        """
+        self._set(":FORM:ELEM", ",".join(elements))
+        if not self.binary:
+            return [float(x) for x in self.CleanString(self._query(command)).split(',')]
+        count = len(elements) * readings
+        try:
+            with self.timer.command(command):
+                self.inst.write(command)
+                # Binary floats can contain the termination byte, so read the exact block size:
+                # "#0", the floats, then the terminator.
+                data = self.inst.read_bytes(2 + 4 * count + 1)
+        except Exception:
+            self.shadow.clear()
+            raise
+        return self.ParseBinary(data, count)
+
+    def reset(self):
+        self.shadow.clear()
+        self._send("*RST")
+
+    def check_errors(self):
+        """Drains the SCPI error queue and returns its messages.
+
+        A rejected command (an out-of-range level, a settings conflict) only shows up here, so
+        any error also clears the shadow and the next _set() of every setting is sent again.
+        """
+        if self.mock:
+            return []
+        errors = []
+        for _ in range(kErrorQueueDepth):
+            response = self.CleanString(self._query(":SYST:ERR?")).strip()
+            if int(response.partition(",")[0]) == 0:
+                break
+            errors.append(response)
+        if errors:
+            self.shadow.clear()
+        return errors
 
     @staticmethod
     def CleanString(inputString):
-        return "".join(filter(lambda x: x in string.printable, inputString))
+        return kNonPrintable.sub("", inputString)
 
     @staticmethod
-    def ParseReading(inputString):
-        cleanedString = Keithley2430.CleanString(inputString)
-        splitString = cleanedString.split(',')
-        dataDict = {'voltage': float(splitString[0]), \
-                    'current': float(splitString[1]), \
-                    'resistance': float(splitString[2]), \
-                    'time': float(splitString[3]), \
-                    'status': float(splitString[4])}
-        return dataDict
+    def ParseBinary(data, count):
+        """Views `count` floats of an SREAL block ("#0" header, host byte order) without copying them."""
+        view = memoryview(data)
+        if view[:2] != b"#0":
+            raise ValueError(f"unexpected binary block header {bytes(view[:2])!r}")
+        return view[2:2 + 4 * count].cast('f')
 
     def close(self):
         if not self.mock:
-            self.inst.write(":OUTP OFF")
+            self._send(":OUTP OFF")
             self.inst.close()
 
     def output_on(self):
-        if not self.mock:
-            self.inst.write(":OUTP ON")
+        self._send(":OUTP ON")
 
     def output_off(self):
-        if not self.mock:
-            self.inst.write(":OUTP OFF")
+        self._send(":OUTP OFF")
     
     def beep_success(self):
         if not self.mock:
-            self.inst.write("SYST:BEEP:IMM 1400, 0.1")
-            time.sleep(0.1)
-            self.inst.write("SYST:BEEP:IMM 2000, 0.05")
-            time.sleep(0.05)
+            self._send("SYST:BEEP:IMM 1400, 0.1")
+            with self.timer.span("dwell", "beep"):
+                time.sleep(0.1)
+            self._send("SYST:BEEP:IMM 2000, 0.05")
+            with self.timer.span("dwell", "beep"):
+                time.sleep(0.05)
+
+    def _measure(self, command, element):
+        reading = self._read(command, (element,))[0]
+        # :MEAS? reconfigures the sense function and trigger model behind the shadow's back.
+        for header in kConfigureSideEffects:
+            self.shadow.pop(header, None)
+        return reading
 
     def measure_voltage(self):
         if self.mock: return 3.7
-        self.inst.write(":SOUR:FUNC:SHAP DC")
-        # :READ? triggers a measurement based on current configuration
-        return self.ParseReading(self.inst.query(":MEAS:VOLT?"))['voltage']
+        self._set(":SOUR:FUNC:SHAP", "DC")
+        return self._measure(":MEAS:VOLT?", "VOLT")
 
     def measure_current(self):
         if self.mock: return 0.0
-        self.inst.write(":SOUR:FUNC:SHAP DC")
-        return self.ParseReading(self.inst.query(":MEAS:CURR?"))['current']
+        self._set(":SOUR:FUNC:SHAP", "DC")
+        return self._measure(":MEAS:CURR?", "CURR")
 
     def source_current(self, current, voltage_limit):
         """Sets the source to current mode with a voltage compliance limit."""
-        if not self.mock:
-            self.inst.write(":SOUR:FUNC:SHAP DC")
-            self.inst.write(":SOUR:FUNC CURR")
-            self.inst.write(f":SOUR:CURR {current}")
-            self.inst.write(f":SENS:VOLT:PROT {voltage_limit}")
+        self._set(":SOUR:FUNC:SHAP", "DC")
+        self._set(":SOUR:FUNC", "CURR")
+        self._set(":SOUR:CURR", current)
+        self._set(":SENS:VOLT:PROT", voltage_limit)
 
     def source_voltage(self, voltage, current_limit):
         """Sets the source to voltage mode with a current compliance limit."""
-        if not self.mock:
-            self.inst.write(":SOUR:FUNC:SHAP DC")
-            self.inst.write(":SOUR:FUNC VOLT")
-            self.inst.write(f":SOUR:VOLT {voltage}")
-            self.inst.write(f":SENS:CURR:PROT {current_limit}")
+        self._set(":SOUR:FUNC:SHAP", "DC")
+        self._set(":SOUR:FUNC", "VOLT")
+        self._set(":SOUR:VOLT", voltage)
+        self._set(":SENS:CURR:PROT", current_limit)
 
     def source_pulse_current(self, current, voltage_limit, width, delay=0):
         """Executes a current pulse and returns the measured voltage."""
-        if self.mock:
-            return 3.8 if current > 0 else 3.6 # Mock voltage rise/drop
-        
         # Configure pulse mode
-        self.inst.write(":SOUR:FUNC:SHAP PULS")
-        self.inst.write(":SOUR:FUNC:MODE CURR")
-        self.inst.write(":SENS:VOLT:RANG 20")
-        self.inst.write(f":SOUR:CURR:LEV {current}")
-        self.inst.write(f":SENS:VOLT:PROT {voltage_limit}")
-        self.inst.write("SENS:FUNC \"VOLT\"")
-        self.inst.write(f":SOUR:PULS:WIDT {width}")
-        self.inst.write(f":SOUR:PULS:DEL {delay}")
+        self._set(":SOUR:FUNC:SHAP", "PULS")
+        self._set(":SOUR:FUNC", "CURR")
+        self._set(":SENS:VOLT:RANG", 20)
+        self._set(":SOUR:CURR", current)
+        self._set(":SENS:VOLT:PROT", voltage_limit)
+        self._set(":SENS:FUNC", "\"VOLT\"")
+        self._set(":SOUR:PULS:WIDT", width)
+        self._set(":SOUR:PULS:DEL", delay)
 
         # Configure for one pulse
-        self.inst.write(":TRIG:CLE")
-        self.inst.write(":ARM:COUN 1")
-        self.inst.write(":TRIG:COUN 1")
+        self._send(":TRIG:CLE")
+        self._set(":ARM:COUN", 1)
+        self._set(":TRIG:COUN", 1)
+
+        if self.mock:
+            return 3.8 if current > 0 else 3.6 # Mock voltage rise/drop
         
         # :READ? initiates the pulse sequence and returns the measurement.
         # Pulse mode automatically turns the output on and off.
-        result = self.ParseReading(self.inst.query(":READ?"))['voltage']
+        result = self._read(":READ?", ("VOLT",))[0]
         
         return result
 
+    def capture_trace(self, current, voltage_limit, duration, points):
+        """Sources a DC current for `duration` seconds while the instrument samples it `points` times.
+
+        The trigger model paces the readings into the trace buffer, which is read back in one
+        transfer once the step is done, so the whole step costs a few bus round trips instead
+        of one per reading. The output is turned off afterwards. Returns a Trace.
+        """
+        self._set(":SOUR:FUNC:SHAP", "DC")
+        self._set(":SOUR:FUNC", "CURR")
+        self._set(":SOUR:CURR", current)
+        self._set(":SENS:VOLT:PROT", voltage_limit)
+        self._set(":SENS:VOLT:NPLC", 1)
+        if self.mock:
+            time.sleep(duration)
+            times = [duration * (k + 1) / points for k in range(points)]
+            sign = 1 if current > 0 else -1
+            return Trace(times, [3.7 + sign * (0.1 + 0.1 * (1 - 2.0 ** -t)) for t in times], [current] * points)
+        nominal_times = [duration * (k + 1) / points for k in range(points)]
+        # Each point is the trigger delay plus a reading, so the last sample lands at `duration`.
+        trigger_delay = max(0.0, duration / points - cell_profiles.kReadingTime_seconds)
+        return self._run_buffered(points, trigger_delay, duration, nominal_times, [current] * points)
+
+    def hold_until_settled(self, current, voltage_limit, settle):
+        """Sources a DC current and reads the voltage as it settles, until it has settled or settle.max_duration has passed.
+
+        The cell counts as settled once the least-squares slope over the trailing settle.window
+        seconds is below settle.tolerance, so a single noisy reading cannot end the step. The
+        output is turned off afterwards. Returns (Trace, reason), reason being "settled" or
+        "max duration".
+        """
+        self.source_current(current, voltage_limit)
+        self._set(":SENS:FUNC", "\"VOLT\"")
+        self._set(":ARM:COUN", 1)
+        self._set(":TRIG:COUN", 1)
+        self._set(":TRIG:DEL", 0)
+        trace = Trace()
+        reason = "max duration"
+        self.output_on()
+        start = time.monotonic()
+        try:
+            while True:
+                if self.mock:
+                    t = time.monotonic() - start
+                    voltage = 3.7 + (1 if current > 0 else -1) * (0.1 + 0.1 * (1 - 2.0 ** -t))
+                else:
+                    voltage = self._read(":READ?", ("VOLT",))[0]
+                elapsed = time.monotonic() - start
+                trace.times.append(elapsed)
+                trace.voltages.append(voltage)
+                trace.currents.append(current)
+                if elapsed >= settle.window and abs(settling_slope(trace.times, trace.voltages, elapsed - settle.window)) < settle.tolerance:
+                    reason = "settled"
+                    break
+                if elapsed >= settle.max_duration:
+                    break
+                with self.timer.span("dwell", "settle poll"):
+                    time.sleep(kSettlePollInterval_seconds)
+        finally:
+            self.output_off()
+        return trace, reason
+
+    def run_source_list(self, currents, voltage_limit, trigger_delay):
+        """Sources each current of a list in turn, one reading per point, as a single sweep.
+
+        The whole list is uploaded once and stepped through by the instrument's trigger model,
+        so step timing does not depend on the host. Returns a Trace with one reading per point.
+        """
+        self._set(":SOUR:FUNC:SHAP", "DC")
+        self._set(":SOUR:FUNC", "CURR")
+        self._set(":SOUR:LIST:CURR", ",".join(f"{c:g}" for c in currents))
+        self._set(":SOUR:CURR:MODE", "LIST")
+        self._set(":SOUR:DEL", 0)
+        self._set(":SENS:VOLT:PROT", voltage_limit)
+        self._set(":SENS:VOLT:NPLC", 1)
+        if self.mock:
+            interval = trigger_delay + cell_profiles.kReadingTime_seconds
+            time.sleep(interval * len(currents))
+            times = [interval * (k + 1) for k in range(len(currents))]
+            trace = Trace(times, [3.7 + 0.07 * c for c in currents], list(currents))
+        else:
+            interval = trigger_delay + cell_profiles.kReadingTime_seconds
+            nominal_times = [interval * (k + 1) for k in range(len(currents))]
+            trace = self._run_buffered(len(currents), trigger_delay, interval * len(currents), nominal_times, currents)
+        self._set(":SOUR:CURR:MODE", "FIX")
+        return trace
+
+    def _run_buffered(self, points, trigger_delay, duration, nominal_times, currents):
+        """Takes `points` readings paced by the trigger delay into the trace buffer and reads them back in one transfer.
+
+        With voltage_only_traces, the returned Trace uses nominal_times and the programmed currents.
+        """
+        self._set(":SENS:FUNC", "\"VOLT\"")
+        self._send(":TRAC:CLE")
+        self._set(":TRAC:POIN", points)
+        self._set(":TRAC:FEED", "SENS")
+        self._set(":TRAC:FEED:CONT", "NEXT")
+        self._set(":ARM:COUN", 1)
+        self._set(":TRIG:COUN", points)
+        self._set(":TRIG:DEL", trigger_delay)
+
+        previous_timeout = self.inst.timeout
+        self.inst.timeout = (duration + 10) * 1000 # *OPC? only answers once the last reading is in
+        try:
+            self._send(":SYST:TIME:RES")
+            self._send(":OUTP ON")
+            self._send(":INIT")
+            # The instrument paces the readings, so the wait is a dwell rather than bus time.
+            self._query("*OPC?", self.timer.span("dwell", "buffered sweep"))
+        finally:
+            self.inst.timeout = previous_timeout
+            self._send(":OUTP OFF")
+        elements = ("VOLT",) if self.voltage_only_traces else ("VOLT", "CURR", "TIME")
+        values = self._read(":TRAC:DATA?", elements, points)
+
+        # Leave the trigger model as the single-reading methods expect it.
+        self._set(":TRAC:FEED:CONT", "NEV")
+        self._set(":TRIG:COUN", 1)
+        self._set(":TRIG:DEL", 0)
+
+        if self.voltage_only_traces:
+            return Trace(nominal_times, values, list(currents))
+        return Trace(values[2::3], values[0::3], values[1::3])
+
+    def wait_for_cell(self, present=True):
+        """Polls the terminal voltage until a cell is seated in the chuck (or, with present False, removed)."""
+        if self.mock:
+            return
+        self.source_current(0.0, kChargeComplianceLimit_volts)
+        while True:
+            voltage = self.measure_voltage()
+            if (kCellPresentMin_volts < voltage < kChargeComplianceLimit_volts) == present:
+                return
+            with self.timer.span("dwell", "cell poll"):
+                time.sleep(kCellPollInterval_seconds)
+
     def test_connection(self):
         """Tests the connection to the instrument by querying its ID."""
         if self.mock:
@@ -150,7 +440,7 @@ class Keithley2430:
             return True
         
         try:
-            idn = self.inst.query("*IDN?")
+            idn = self._query("*IDN?")
             self.beep_success()
             print(f"Connection successful. Instrument ID: {idn.strip()}")
             return True
@@ -158,66 +448,129 @@ class Keithley2430:
             print(f"Connection failed: {e}")
             return False
 
-def run_tests(inst, serial_number):
-    print(f"Testing cell {serial_number}...")
+def run_tests(inst, serial_number, trace=False, program=None, log=print, ready=None, settle=None):
+    """Runs the OCV, R0 and DCIR tests on one cell and returns (results, traces).
+
+    With trace set, each DCIR hold is sampled on the instrument with capture_trace() and the
+    traces are returned by step name; otherwise traces is empty. With SettleCriteria as settle,
+    each DCIR hold instead ends once the voltage has settled (hold_until_settled()); its readings
+    are returned as the trace, and the hold times and stop reasons are added to the results.
+    With a compiled test profile as program, it replaces the DCIR holds: it runs as one
+    source-list sweep, its trace is returned under the profile's name, and its steps fill the
+    DCIR columns they name. Progress goes through log, so concurrent stations can label their
+    output. ready, if given, is called as soon as the last step turns the output off and the
+    cell can be removed. Each test is a phase on inst.timer.
+    """
+    timer = inst.timer
+    log(f"Testing cell {serial_number}...")
+    traces = {}
+    holds = {}
+    writes_sent, writes_saved = inst.writes_sent, inst.writes_saved
     
     # 1. Open Circuit Voltage
-    print("  Measuring OCV...")
+    timer.phase("ocv")
+    log("  Measuring OCV...")
     inst.source_current(0.0, kChargeComplianceLimit_volts)
-    time.sleep(kVoltageSenseDwell_seconds)
+    with timer.span("dwell", "voltage sense"):
+        time.sleep(kVoltageSenseDwell_seconds)
     ocv = inst.measure_voltage()
-    print(f"  OCV: {ocv:.4f} V")
+    log(f"  OCV: {ocv:.4f} V")
 
     # 2. R0 Estimate
-    print("  Measuring R0...")
+    timer.phase("r0")
+    log("  Measuring R0...")
     # Measure idle voltage for charge
     v_idle_charge = inst.measure_voltage()
     
     # Charge Pulse
-    print(f"  Pulsing {kR0PulseCurrent_amps}A for {kR0PulseDuration_seconds}s...")
+    log(f"  Pulsing {kR0PulseCurrent_amps}A for {kR0PulseDuration_seconds}s...")
     v_load_charge = inst.source_pulse_current(kR0PulseCurrent_amps, kChargeComplianceLimit_volts, kR0PulseDuration_seconds)
     
     # Measure idle voltage for discharge
-    print("  Measuring OCV...")
+    log("  Measuring OCV...")
     v_idle_discharge = inst.measure_voltage()
 
     # Discharge Pulse
-    print(f"  Pulsing {-kR0PulseCurrent_amps}A for {kR0PulseDuration_seconds}s...")
+    log(f"  Pulsing {-kR0PulseCurrent_amps}A for {kR0PulseDuration_seconds}s...")
     v_load_discharge = inst.source_pulse_current(-kR0PulseCurrent_amps, kDischargeCompianceLimit_volts, kR0PulseDuration_seconds)
 
     r_charge = (v_load_charge - v_idle_charge) / kR0PulseCurrent_amps
     r_discharge = (v_idle_discharge - v_load_discharge) / kR0PulseCurrent_amps # Delta V / Delta I. Delta I is positive magnitude here.
     r0 = (r_charge + r_discharge) / 2.0
-    print(f"  R0: {r0:.4f} Ohm")
+    log(f"  R0: {r0:.4f} Ohm")
 
     # 3. DCIR Test
-    print("  Measuring DCIR...")
-    # Measure idle voltage for charge
-    v_idle_charge_dcir = inst.measure_voltage()
+    timer.phase("dcir")
+    if program:
+        log(f"  Running profile {program.profile.name} ({len(program.currents)} points)...")
+        profile_trace = inst.run_source_list(program.currents, program.profile.voltage_limit, program.trigger_delay)
+        traces[program.profile.name] = profile_trace
+        resistances = cell_profiles.step_resistances(program, profile_trace)
+        columns = {step.result: resistances.get(step.name, math.nan) for step in program.profile.steps if step.result}
+        r_charge_dcir = columns.get("DCIR Charge (Ohm)", math.nan)
+        r_discharge_dcir = columns.get("DCIR Discharge (Ohm)", math.nan)
+        # Average whichever directions the profile measured.
+        measured = [r for r in (r_charge_dcir, r_discharge_dcir) if not math.isnan(r)]
+        dcir = sum(measured) / len(measured) if measured else math.nan
+    else:
+        log("  Measuring DCIR...")
+        # Measure idle voltage for charge
+        v_idle_charge_dcir = inst.measure_voltage()
     
-    # Charge
-    print(f"  Sourcing {kDcirCurrent_amps}A for {kDcirDuration_seconds} seconds...")
-    inst.source_current(kDcirCurrent_amps, kChargeComplianceLimit_volts)
-    inst.output_on()
-    time.sleep(kDcirDuration_seconds)
-    v_load_charge_dcir = inst.measure_voltage()
-    inst.output_off()
-
-    # Measure idle voltage for discharge
-    v_idle_discharge_dcir = inst.measure_voltage()
-
-    # Discharge
-    print(f"  Sourcing {-kDcirCurrent_amps}A for {kDcirDuration_seconds} seconds...")
-    inst.source_current(-kDcirCurrent_amps, kDischargeCompianceLimit_volts)
-    inst.output_on()
-    time.sleep(kDcirDuration_seconds)
-    v_load_discharge_dcir = inst.measure_voltage()
-    inst.output_off()
-
-    r_charge_dcir = (v_load_charge_dcir - v_idle_charge_dcir) / kDcirCurrent_amps
-    r_discharge_dcir = (v_idle_discharge_dcir - v_load_discharge_dcir) / kDcirCurrent_amps
-    dcir = (r_charge_dcir + r_discharge_dcir) / 2.0
-    print(f"  DCIR: {dcir:.4f} Ohm")
+        # Charge
+        if settle:
+            log(f"  Sourcing {kDcirCurrent_amps}A for up to {settle.max_duration} seconds...")
+            traces["dcir_charge"], reason = inst.hold_until_settled(kDcirCurrent_amps, kChargeComplianceLimit_volts, settle)
+            v_load_charge_dcir = traces["dcir_charge"].voltages[-1]
+            holds["Charge"] = (traces["dcir_charge"].times[-1], reason)
+            log(f"  Held {holds['Charge'][0]:.1f} s ({reason})")
+        elif trace:
+            log(f"  Sourcing {kDcirCurrent_amps}A for {kDcirDuration_seconds} seconds...")
+            traces["dcir_charge"] = inst.capture_trace(kDcirCurrent_amps, kChargeComplianceLimit_volts, kDcirDuration_seconds, kTracePoints)
+            v_load_charge_dcir = traces["dcir_charge"].voltages[-1]
+        else:
+            log(f"  Sourcing {kDcirCurrent_amps}A for {kDcirDuration_seconds} seconds...")
+            inst.source_current(kDcirCurrent_amps, kChargeComplianceLimit_volts)
+            inst.output_on()
+            with timer.span("dwell", "dcir hold"):
+                time.sleep(kDcirDuration_seconds)
+            v_load_charge_dcir = inst.measure_voltage()
+            inst.output_off()
+
+        # Measure idle voltage for discharge
+        v_idle_discharge_dcir = inst.measure_voltage()
+
+        # Discharge
+        if settle:
+            log(f"  Sourcing {-kDcirCurrent_amps}A for up to {settle.max_duration} seconds...")
+            traces["dcir_discharge"], reason = inst.hold_until_settled(-kDcirCurrent_amps, kDischargeCompianceLimit_volts, settle)
+            v_load_discharge_dcir = traces["dcir_discharge"].voltages[-1]
+            holds["Discharge"] = (traces["dcir_discharge"].times[-1], reason)
+            log(f"  Held {holds['Discharge'][0]:.1f} s ({reason})")
+        elif trace:
+            log(f"  Sourcing {-kDcirCurrent_amps}A for {kDcirDuration_seconds} seconds...")
+            traces["dcir_discharge"] = inst.capture_trace(-kDcirCurrent_amps, kDischargeCompianceLimit_volts, kDcirDuration_seconds, kTracePoints)
+            v_load_discharge_dcir = traces["dcir_discharge"].voltages[-1]
+        else:
+            log(f"  Sourcing {-kDcirCurrent_amps}A for {kDcirDuration_seconds} seconds...")
+            inst.source_current(-kDcirCurrent_amps, kDischargeCompianceLimit_volts)
+            inst.output_on()
+            with timer.span("dwell", "dcir hold"):
+                time.sleep(kDcirDuration_seconds)
+            v_load_discharge_dcir = inst.measure_voltage()
+            inst.output_off()
+
+        r_charge_dcir = (v_load_charge_dcir - v_idle_charge_dcir) / kDcirCurrent_amps
+        r_discharge_dcir = (v_idle_discharge_dcir - v_load_discharge_dcir) / kDcirCurrent_amps
+        dcir = (r_charge_dcir + r_discharge_dcir) / 2.0
+    if ready:
+        ready()
+    timer.phase("results")
+    errors = inst.check_errors()
+    if errors:
+        log(f"  Warning: the instrument reported errors during the tests: {'; '.join(errors)}")
+    log(f"  DCIR: {dcir:.4f} Ohm")
+    log(f"  Configuration writes: {inst.writes_sent - writes_sent} sent, {inst.writes_saved - writes_saved} skipped as redundant")
 
     results = {
         "Serial Number": serial_number,
@@ -229,64 +582,357 @@ def run_tests(inst, serial_number):
         "DCIR Charge (Ohm)": r_charge_dcir,
         "DCIR Discharge (Ohm)": r_discharge_dcir
     }
+    for direction, (duration, reason) in holds.items():
+        results[f"DCIR {direction} Hold (s)"] = duration
+        results[f"DCIR {direction} Stop"] = reason
     
-    return results
+    return results, traces
+
+def write_traces(directory, serial_number, traces):
+    """Writes one CSV per cell with every captured step's readings."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{serial_number}.csv"), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Step", "Time (s)", "Voltage (V)", "Current (A)"])
+        for step, trace in traces.items():
+            for row in zip(trace.times, trace.voltages, trace.currents):
+                writer.writerow((step,) + row)
+
+def save_traces(trace_dir, archive, serial_number, traces, timer=cycle_timer.kNullTimer):
+    """Writes a cell's traces to trace_dir and archive, whichever are given.
+
+    Call it after the result row is saved: a failure here only warns, so it never costs the result.
+    """
+    if traces and trace_dir:
+        try:
+            with timer.span("save", "traces"):
+                write_traces(trace_dir, serial_number, traces)
+        except OSError as e:
+            print(f"Warning: could not write the traces of {serial_number}: {e}")
+    if traces and archive is not None:
+        try:
+            with timer.span("save", "archive"):
+                archive.append_traces(serial_number, traces)
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not archive the traces of {serial_number}: {e}")
+
+class ResultSink:
+    """Writes results from any number of stations through a single writer thread.
+
+    Stations hand over finished cells with submit(); the journal, trace files and database are
+    only touched by the writer thread, so concurrent stations never interleave rows. Traces also
+    go to archive, a waveform_archive.WaveformArchive, if given. Each write is timed on timer.
+    """
+    def __init__(self, journal, trace_dir=None, database=None, timer=None, archive=None):
+        self.timer = timer or cycle_timer.kNullTimer
+        self.journal = journal
+        self.archive = archive
+        self.trace_dir = trace_dir
+        self.database = database
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, station, results, traces):
+        self.queue.put((station, results, traces))
+
+    def close(self):
+        """Waits for every submitted result to be written."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        db = CellDatabase(self.database) if self.database else None # SQLite connections stay on their own thread
+        try:
+            while (item := self.queue.get()) is not None:
+                station, results, traces = item
+                try:
+                    with self.timer.span("save", "csv"):
+                        self.journal.write(results)
+                    if db:
+                        with self.timer.span("save", "database"):
+                            db.insert([results], station)
+                except Exception as e:
+                    print(f"Error saving results for {results['Serial Number']}: {e}")
+                save_traces(self.trace_dir, self.archive, results["Serial Number"], traces, self.timer)
+        finally:
+            if db:
+                db.close()
+
+def open_instrument(args, resource, timer=None):
+    return Keithley2430(resource, mock=args.mock, terminals=args.terminals, binary=args.binary,
+                        voltage_only_traces=args.voltage_only_traces, simulate=args.simulate, timer=timer)
+
+def make_timer(args, name):
+    """A CycleTimer when --timing-report is given, otherwise the no-op timer."""
+    return cycle_timer.CycleTimer(name) if args.timing_report else cycle_timer.kNullTimer
+
+def wants_traces(args):
+    return bool(args.trace_dir or args.waveform_archive)
+
+def accept_scan(journal, archive, serial_number):
+    """Checks a scanned serial number before its cell is tested. Returns False to reject the scan."""
+    if archive is not None:
+        try:
+            archive.check_names(serial_number)
+        except ValueError as e:
+            print(f"Error: {e}; not testing {serial_number}")
+            return False
+    if serial_number in journal:
+        print(f"Warning: {serial_number} has already been tested; this result will be recorded as a retest")
+    return True
+
+def save_timing_report(file_path, timers):
+    cells = cycle_timer.write_report(file_path, timers)
+    cycle = f", mean cycle time {sum(c['cycle_seconds'] for c in cells) / len(cells):.1f} s" if cells else ""
+    print(f"Timing report for {len(cells)} cells written to {file_path}{cycle}")
+
+print_lock = threading.Lock()
+
+def run_station(name, inst, scans, sink, trace, program, settle=None):
+    """Tests cells from the shared scan queue on one instrument until it receives None."""
+    def log(message):
+        with print_lock: # One print is two writes; keep stations' lines whole
+            print(f"[{name}] {message}")
+
+    timer = inst.timer
+    last_ready = None
+    timer.phase("waiting for scan")
+    while (serial_number := scans.get()) is not None:
+        log(f"Insert {serial_number} into this station")
+        def ready():
+            # The output is off: the operator can swap cells while results are computed and saved.
+            nonlocal last_ready
+            now = time.monotonic()
+            cycle = f" (cycle time {now - last_ready:.1f} s)" if last_ready else ""
+            last_ready = now
+            log(f"Ready for swap: remove {serial_number}{cycle}")
+            inst.beep_success()
+        try:
+            timer.phase("wait for cell")
+            inst.wait_for_cell(present=True)
+            results, traces = run_tests(inst, serial_number, trace, program, log=log, ready=ready, settle=settle)
+            sink.submit(name, results, traces)
+            log(f"Test complete for {serial_number}.")
+            timer.phase("wait for removal")
+            inst.wait_for_cell(present=False)
+        except Exception as e:
+            log(f"Error testing {serial_number}: {e}")
+            try:
+                inst.output_off()
+            except Exception:
+                pass
+        timer.end_cell(serial_number)
+        timer.phase("waiting for scan")
+
+def run_stations(args, journal, program, settle=None, archive=None):
+    """Drives one instrument and chuck per --resource from a shared barcode queue.
+
+    Each scan goes to the next free station, which announces itself, starts once the cell is
+    seated and waits for it to be removed before taking the next scan.
+    """
+    sink = ResultSink(journal, args.trace_dir, args.database, make_timer(args, "writer"), archive)
+    scans = queue.Queue()
+    stations = []
+    try:
+        for i, resource in enumerate(args.resource):
+            name = f"{args.station}-{i + 1}" if args.station else resource
+            stations.append((name, open_instrument(args, resource, make_timer(args, name))))
+        threads = [threading.Thread(target=run_station, args=(name, inst, scans, sink, wants_traces(args), program, settle))
+                   for name, inst in stations]
+        for thread in threads:
+            thread.start()
+        # Stations print while the operator scans, so there is no per-line prompt to get overwritten.
+        if len(stations) > 1:
+            print(f"{len(stations)} stations ready. Scan barcodes as cells are picked up; each is assigned to the next free station.")
+        else:
+            print("Station ready. Scan the next cell while the current one is testing; scans are queued in order.")
+        print("Enter 'q' to quit once the queued cells are done.")
+        try:
+            while True:
+                serial_number = input().strip()
+                if serial_number.lower() == 'q':
+                    break
+                if serial_number and accept_scan(journal, archive, serial_number):
+                    scans.put(serial_number)
+        except (KeyboardInterrupt, EOFError):
+            pass
+        print("Finishing queued cells...")
+        for _ in threads:
+            scans.put(None)
+        for thread in threads:
+            thread.join()
+    except Exception as e:
+        print(f"Failed to initialize instrument: {e}")
+    finally:
+        for _, inst in stations:
+            inst.close()
+        sink.close()
+        if args.timing_report:
+            save_timing_report(args.timing_report, [inst.timer for _, inst in stations] + [sink.timer])
 
 def main():
     parser = argparse.ArgumentParser(description="Battery Cell Testing Script")
     parser.add_argument("output_csv", help="Path to the output CSV file")
-    parser.add_argument("--resource", default="GPIB0::24::INSTR", help="VISA resource string for Keithley 2430")
+    parser.add_argument("--resource", default=["GPIB0::24::INSTR"], nargs="+",
+                        help="VISA resource string for Keithley 2430; give several to run one station per instrument concurrently")
     parser.add_argument("--mock", action="store_true", help="Run in mock mode without hardware")
+    parser.add_argument("--simulate", action="store_true",
+                        help="Run against a simulated 2430 and cell with realistic timing instead of hardware (see simulated_sourcemeter.py)")
     parser.add_argument("--terminals", choices=['front', 'rear'], default='front', help="Select front or rear terminals (default: front)")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Queue scans while a test runs and start each test as soon as its cell is seated (implied by several resources)")
+    parser.add_argument("--binary", action="store_true",
+                        help="Transfer readings as binary floats instead of ASCII text (much less serial traffic for traces)")
+    parser.add_argument("--voltage-only-traces", action="store_true",
+                        help="Only transfer voltages for traces; times and currents are the programmed values")
     parser.add_argument("--test-connection", action="store_true", help="Test connection to the instrument and exit")
+    parser.add_argument("--trace-dir", default=None,
+                        help=f"Sample each DCIR hold {kTracePoints} times on the instrument and save the traces here, one CSV per cell")
+    parser.add_argument("--waveform-archive", default=None,
+                        help="Capture the DCIR traces (as --trace-dir does) and append them to this binary archive (see waveform_archive.py)")
+    parser.add_argument("--profile", default=None,
+                        help="JSON test profile (see profiles/) to run in place of the DCIR holds as one instrument-timed sweep")
+    parser.add_argument("--adaptive-dcir", action="store_true",
+                        help="End each DCIR hold once the voltage has settled instead of after a fixed time; records hold times and stop reasons")
+    parser.add_argument("--settle-tolerance", type=float, default=kSettleTolerance_volts_per_second,
+                        help=f"Drift in V/s below which an adaptive DCIR hold counts as settled (default: {kSettleTolerance_volts_per_second})")
+    parser.add_argument("--max-hold", type=float, default=kDcirDuration_seconds,
+                        help=f"Longest adaptive DCIR hold in seconds (default: {kDcirDuration_seconds})")
+    parser.add_argument("--database", default=None, help="Also record results in this SQLite cell database (see cell_database.py)")
+    parser.add_argument("--fsync", choices=result_journal.kSyncPolicies, default="row",
+                        help="When results are forced to disk: after every row (default), in batches, or only when the OS decides")
+    parser.add_argument("--timing-report", default=None,
+                        help="Time every instrument command, test phase and save, and write per-cell breakdowns and latency histograms to this JSON file at the end")
+    parser.add_argument("--station", default=None,
+                        help="Station name recorded with each result in --database (with several resources, a prefix numbered per station)")
     args = parser.parse_args()
+    if args.mock and args.simulate:
+        parser.error("--mock and --simulate are mutually exclusive")
+
+    if args.adaptive_dcir and args.profile:
+        parser.error("--adaptive-dcir applies to the built-in DCIR holds, which --profile replaces")
+    settle = SettleCriteria(args.settle_tolerance, args.max_hold) if args.adaptive_dcir else None
+
+    program = None
+    if args.profile:
+        try:
+            program = cell_profiles.compile_profile(cell_profiles.load_profile(args.profile))
+        except (OSError, cell_profiles.ProfileError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
 
-    # Initialize CSV
     # Initialize CSV
     fieldnames = ["Serial Number", "OCV (V)", "R0 (Ohm)", "R0 Charge (Ohm)", "R0 Discharge (Ohm)", "DCIR (Ohm)", "DCIR Charge (Ohm)", "DCIR Discharge (Ohm)"]
-    
-    # Check if file exists to decide whether to write header
+    if settle:
+        fieldnames += ["DCIR Charge Hold (s)", "DCIR Charge Stop", "DCIR Discharge Hold (s)", "DCIR Discharge Stop"]
+
+    if args.test_connection:
+        success = True
+        for resource in args.resource:
+            inst = open_instrument(args, resource)
+            success = inst.test_connection() and success
+            inst.close()
+        sys.exit(0 if success else 1)
+
+    # Creates the file with a header, or checks and recovers an existing one to append to.
     try:
-        with open(args.output_csv, 'x', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-    except FileExistsError:
-        pass # Append to existing file
+        journal = result_journal.ResultJournal(args.output_csv, fieldnames, args.fsync)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if journal.recovered_bytes:
+        print(f"Warning: {args.output_csv} ended in a partial row, probably from a crash; "
+              f"moved its {journal.recovered_bytes} bytes to {journal.partial_path}")
+    if journal.rows:
+        print(f"Appending to {args.output_csv}, which holds {journal.rows} results for {len(journal.serials)} cells")
+
+    archive = None
+    if args.waveform_archive:
+        try:
+            import waveform_archive # Needs numpy, which nothing else at the station does
+            archive = waveform_archive.WaveformArchive(args.waveform_archive, "a")
+        except ImportError:
+            print("Error: --waveform-archive needs numpy (pip install numpy)")
+            sys.exit(1)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        try:
+            # Step names are fixed by the test, so a name the index cannot hold is caught before any cell is tested.
+            for step in [program.profile.name] if program else ["dcir_charge", "dcir_discharge"]:
+                archive.check_names(step=step)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        if archive.recovered_bytes:
+            print(f"Warning: {args.waveform_archive} ended in an incomplete trace, probably from a crash; "
+                  f"removed its {archive.recovered_bytes} bytes")
+
+    if len(args.resource) > 1 or args.pipelined:
+        try:
+            run_stations(args, journal, program, settle, archive)
+        finally:
+            journal.close()
+            if archive is not None:
+                archive.close()
+        return
+
+    db = CellDatabase(args.database) if args.database else None
+    timer = make_timer(args, args.station)
 
     try:
-        inst = Keithley2430(args.resource, mock=args.mock, terminals=args.terminals)
-        
-        if args.test_connection:
-            success = inst.test_connection()
-            sys.exit(0 if success else 1)
+        inst = open_instrument(args, args.resource[0], timer)
 
         while True:
+            serial_number = None
             try:
+                timer.phase("waiting for scan")
                 serial_number = input("Scan barcode (or 'q' to quit): ").strip()
                 if serial_number.lower() == 'q':
                     break
-                if not serial_number:
+                if not serial_number or not accept_scan(journal, archive, serial_number):
                     continue
 
-                results = run_tests(inst, serial_number)
-                
-                with open(args.output_csv, 'a', newline='') as csvfile:
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                    writer.writerow(results)
+                results, traces = run_tests(inst, serial_number, trace=wants_traces(args), program=program, settle=settle)
+                timer.phase("save")
+                journal.write(results)
+                if db:
+                    db.insert([results], args.station)
+                save_traces(args.trace_dir, archive, serial_number, traces)
                 
                 print(f"Test complete for {serial_number}. Results saved.")
+                timer.phase("beep")
                 inst.beep_success()
-                
-            except KeyboardInterrupt:
+                if args.simulate:
+                    # The beep cues the simulated operator to swap cells. Wait for the swap here, as
+                    # the operator would before scanning, so the next test doesn't start on the old
+                    # cell and finish on the new one.
+                    timer.phase("wait for removal")
+                    inst.wait_for_cell(present=False)
+                    timer.phase("wait for cell")
+                    inst.wait_for_cell(present=True)
+                timer.end_cell(serial_number)
+
+            except (KeyboardInterrupt, EOFError):
                 break
             except Exception as e:
                 print(f"Error testing cell: {e}")
+                if serial_number is not None: # Only a scanned cell has a cycle to file
+                    timer.end_cell(serial_number)
 
     except Exception as e:
         print(f"Failed to initialize instrument: {e}")
     finally:
         if 'inst' in locals():
             inst.close()
+        journal.close()
+        if archive is not None:
+            archive.close()
+        if db:
+            db.close()
+        if args.timing_report:
+            save_timing_report(args.timing_report, [timer])
 
 if __name__ == "__main__":
     main()
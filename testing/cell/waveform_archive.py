@@ -0,0 +1,189 @@
+import argparse
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+
+# Samples are stored as the 2430 transfers them with :FORM:DATA SREAL: 4-byte floats.
+kSampleDtype = np.dtype([("time", "<f4"), ("voltage", "<f4"), ("current", "<f4")])
+# One index record per block: which cell and step it is, and where its samples are.
+kIndexDtype = np.dtype([("serial", "S32"), ("step", "S24"), ("offset", "<u8"), ("count", "<u4"), ("recorded_at", "<f8")])
+
+kDataMagic = b"WFDATA1\0"
+kIndexMagic = b"WFINDEX1"
+kIndexSuffix = ".idx"
+
+class WaveformArchive:
+    """Append-only store of sample traces, indexed by serial number and step name.
+
+    The samples of every trace live in one file (path) as blocks of kSampleDtype records, and
+    a second file (path + ".idx") holds one fixed-size kIndexDtype record per block. Opening
+    the archive reads the index into a dict, so finding a cell's trace is O(1), and trace()
+    returns a view into the memory-mapped sample file without copying or parsing anything.
+    records() returns the whole index for scanning every trace through samples.
+    A cell tested twice keeps both traces; lookups return the latest.
+
+    Samples are written and synced before their index record, so a crash can only leave an
+    incomplete index record or samples that no index record points to. Opening the archive for
+    appending cuts both off.
+    """
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "a"):
+            raise ValueError(f"mode must be 'r' or 'a', not {mode!r}")
+        self.path = path
+        self.index_path = path + kIndexSuffix
+        self.writable = mode == "a"
+        self.recovered_bytes = 0
+        if self.writable:
+            for file_path, magic in ((self.path, kDataMagic), (self.index_path, kIndexMagic)):
+                if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+                    with open(file_path, 'wb') as f:
+                        f.write(magic)
+        self._check_magic(self.path, kDataMagic)
+        self._check_magic(self.index_path, kIndexMagic)
+        self._load_index()
+        if self.writable:
+            self._recover()
+            self.data_file = open(self.path, 'ab')
+            self.index_file = open(self.index_path, 'ab')
+        self._mapped = None
+
+    @staticmethod
+    def _check_magic(file_path, magic):
+        with open(file_path, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError(f"{file_path} is not a waveform archive file")
+
+    def records(self):
+        """The whole index as a kIndexDtype array, one record per stored trace in the order written."""
+        count = (os.path.getsize(self.index_path) - len(kIndexMagic)) // kIndexDtype.itemsize
+        return np.fromfile(self.index_path, dtype=kIndexDtype, count=count, offset=len(kIndexMagic))
+
+    def _load_index(self):
+        index = self.records()
+        self.record_count = len(index)
+        self.blocks = {} # serial -> {step: (offset, count)}, latest record wins
+        for serial, step, offset, count in zip(index["serial"].tolist(), index["step"].tolist(),
+                                               index["offset"].tolist(), index["count"].tolist()):
+            self.blocks.setdefault(serial.decode(), {})[step.decode()] = (offset, count)
+        self.sample_count = int((index["offset"] + index["count"]).max()) if len(index) else 0
+
+    def _recover(self):
+        index_end = len(kIndexMagic) + self.record_count * kIndexDtype.itemsize
+        data_end = len(kDataMagic) + self.sample_count * kSampleDtype.itemsize
+        for file_path, end in ((self.index_path, index_end), (self.path, data_end)):
+            size = os.path.getsize(file_path)
+            if size > end:
+                with open(file_path, 'rb+') as f:
+                    f.truncate(end)
+                self.recovered_bytes += size - end
+
+    def __contains__(self, serial_number):
+        return serial_number in self.blocks
+
+    def __len__(self):
+        return self.record_count
+
+    def serials(self):
+        return list(self.blocks)
+
+    def steps(self, serial_number):
+        return list(self.blocks.get(serial_number, {}))
+
+    @property
+    def samples(self):
+        """Every stored sample as one read-only structured array over the memory-mapped file."""
+        if self._mapped is None or len(self._mapped) != self.sample_count:
+            if self.sample_count == 0:
+                return np.empty(0, dtype=kSampleDtype)
+            self._mapped = np.memmap(self.path, dtype=kSampleDtype, mode='r', offset=len(kDataMagic), shape=(self.sample_count,))
+        return self._mapped
+
+    def trace(self, serial_number, step=None):
+        """The latest trace of a cell's step (or of its only step) as a view with time, voltage and current fields."""
+        steps = self.blocks.get(serial_number)
+        if not steps:
+            raise KeyError(serial_number)
+        if step is None:
+            if len(steps) != 1:
+                raise ValueError(f"{serial_number} has steps {', '.join(steps)}; name one")
+            step = next(iter(steps))
+        offset, count = steps[step]
+        return self.samples[offset:offset + count]
+
+    @staticmethod
+    def check_names(serial_number=None, step=None):
+        """Raises ValueError if a serial number or step name cannot be stored in an index record."""
+        for field, value in (("serial", serial_number), ("step", step)):
+            if value is None:
+                continue
+            encoded = value.encode()
+            if len(encoded) > kIndexDtype[field].itemsize or encoded.endswith(b"\0"):
+                raise ValueError(f"{field} {value!r} does not fit the archive index ({kIndexDtype[field].itemsize} bytes)")
+
+    def append(self, serial_number, step, times, voltages, currents, recorded_at=None):
+        """Appends one trace."""
+        if not self.writable:
+            raise ValueError(f"{self.path} is open read-only")
+        self.check_names(serial_number, step)
+        block = np.empty(len(voltages), dtype=kSampleDtype)
+        block["time"], block["voltage"], block["current"] = times, voltages, currents
+        record = np.zeros(1, dtype=kIndexDtype)
+        record["serial"], record["step"] = serial_number.encode(), step.encode()
+        record["offset"], record["count"] = self.sample_count, len(block)
+        record["recorded_at"] = time.time() if recorded_at is None else recorded_at
+
+        self.data_file.write(block.tobytes())
+        self.data_file.flush()
+        os.fsync(self.data_file.fileno())
+        self.index_file.write(record.tobytes())
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+
+        self.blocks.setdefault(serial_number, {})[step] = (self.sample_count, len(block))
+        self.sample_count += len(block)
+        self.record_count += 1
+
+    def append_traces(self, serial_number, traces):
+        """Appends test_cells.py traces, a dict of step name -> Trace."""
+        for step, trace in traces.items():
+            self.append(serial_number, step, trace.times, trace.voltages, trace.currents)
+
+    def close(self):
+        self._mapped = None
+        if self.writable:
+            self.data_file.close()
+            self.index_file.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="List a waveform archive, or print one cell's trace as CSV")
+    parser.add_argument("archive", help="Archive written by test_cells.py --waveform-archive")
+    parser.add_argument("serial", nargs="?", help="Serial number of the cell whose trace to print")
+    parser.add_argument("--step", default=None, help="Step to print when the cell has several, e.g. dcir_charge")
+    args = parser.parse_args()
+
+    try:
+        archive = WaveformArchive(args.archive)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if not args.serial:
+        print(f"{len(archive)} traces of {len(archive.serials())} cells, {archive.sample_count} samples")
+        return
+    try:
+        trace = archive.trace(args.serial, args.step)
+    except KeyError:
+        print(f"Error: no {args.step + ' ' if args.step else ''}trace for {args.serial}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["Time (s)", "Voltage (V)", "Current (A)"])
+    # Seven significant digits is all a 4-byte float holds.
+    writer.writerows([f"{value:.7g}" for value in sample] for sample in trace.tolist())
+
+if __name__ == "__main__":
+    main()